@@ -0,0 +1,108 @@
+import argparse
+import logging
+import sys
+import tarfile
+
+import docker
+
+from utils import CHUNK_SIZE, delete_file_if_exists, is_file_intact, load_manifest
+
+cli = docker.client.from_env()
+
+log = logging.getLogger(__name__)
+
+
+def read_chunks(f):
+    """Read a file-like object in chunks, so that it is streamed to docker."""
+    return iter(lambda: f.read(CHUNK_SIZE), b"")
+
+
+def verify_archive(archive, manifest: dict) -> bool:
+    """Check the size and sha256 of the archive against its manifest."""
+    entry = manifest.get("archive")
+    if not entry:
+        log.error("The manifest has no archive to verify.")
+        return False
+
+    if not is_file_intact(archive, entry["size"], entry["sha256"]):
+        log.error(
+            "'%s' doesn't match the size and sha256 of '%s' in the manifest.",
+            archive,
+            entry["file"],
+        )
+        return False
+
+    log.info("'%s' matches the manifest, with %s images.", archive, len(manifest["images"]))
+    return True
+
+
+def load_images(data) -> list[str]:
+    """Load a `docker save` archive into docker and return the image tags."""
+    images = cli.images.load(data)
+    tags = [tag for img in images for tag in img.tags]
+    for tag in tags:
+        log.info("Loaded image: %s", tag)
+    return tags
+
+
+def is_per_image_archive(archive) -> bool:
+    """Return whether the archive holds a tar per image, or a single layout."""
+    with tarfile.open(archive, "r|*") as tar:
+        member = tar.next()
+        return member is not None and member.name.endswith(".tar")
+
+
+def load_per_image_archive(archive) -> list[str]:
+    """Load the images of a per-image archive, without extracting it."""
+    tags = []
+    with tarfile.open(archive, "r|*") as tar:
+        for member in tar:
+            if not member.isfile():
+                continue
+
+            log.info("Loading images from '%s'.", member.name)
+            tags.extend(load_images(read_chunks(tar.extractfile(member))))
+
+    return tags
+
+
+def load_archive(archive) -> list[str]:
+    """Load all the images of an archive created by save-images-to-tar.py."""
+    if is_per_image_archive(archive):
+        return load_per_image_archive(archive)
+
+    # Docker loads the gzipped archive as is, with every layer blob stored once
+    log.info("Loading images from '%s'. Will take a while...", archive)
+    with open(archive, "rb") as f:
+        return load_images(f)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Load images from tar.gz")
+    parser.add_argument("archive", nargs="?", default="images.tar.gz")
+    parser.add_argument(
+        "--delete", action="store_true", help="Delete the archive once its images are loaded"
+    )
+    parser.add_argument(
+        "--manifest",
+        help="Manifest created by save-images-to-tar.py, to "
+        "verify the archive against before loading it",
+    )
+    parser.add_argument(
+        "--verify-only", action="store_true", help="Only verify the archive against the manifest"
+    )
+    args = parser.parse_args()
+    if args.verify_only and not args.manifest:
+        parser.error("--verify-only requires --manifest")
+
+    if args.manifest:
+        if not verify_archive(args.archive, load_manifest(args.manifest)):
+            sys.exit(1)
+        if args.verify_only:
+            sys.exit(0)
+
+    tags = load_archive(args.archive)
+    log.info("Successfully loaded %s images!", len(tags))
+
+    if args.delete:
+        delete_file_if_exists(args.archive)
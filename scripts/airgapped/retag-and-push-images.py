@@ -0,0 +1,174 @@
+import argparse
+import logging
+import sys
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+import docker
+import requests
+
+from utils import get_images_list_from_file, get_or_pull_image, get_retagged_image_name
+
+cli = docker.client.from_env()
+
+log = logging.getLogger(__name__)
+
+MANIFEST_TYPES = [
+    "application/vnd.docker.distribution.manifest.v2+json",
+    "application/vnd.docker.distribution.manifest.list.v2+json",
+    "application/vnd.oci.image.manifest.v1+json",
+    "application/vnd.oci.image.index.v1+json",
+]
+
+# Statuses of the push of a layer worth logging, the rest is progress bars
+PUSH_STATUSES = ["Pushed", "Layer already exists", "Mounted from"]
+
+
+def split_image_name(image_nm: str) -> tuple[str, str, str]:
+    """Split a retagged image name into its registry, repository and tag."""
+    registry, path = image_nm.split("/", 1)
+    repository, _, tag = path.partition(":")
+    return registry, repository, tag or "latest"
+
+
+def get_registry_digest(image_nm: str, scheme: str) -> str | None:
+    """Return the manifest digest of the image in its registry, if any.
+
+    Only the headers of the manifest are requested, with the v2 API of the
+    registry, i.e. HEAD /v2/<repository>/manifests/<tag>.
+    """
+    registry, repository, tag = split_image_name(image_nm)
+    url = "%s://%s/v2/%s/manifests/%s" % (scheme, registry, repository, tag)
+    try:
+        headers = {"Accept": ", ".join(MANIFEST_TYPES)}
+        resp = requests.head(url, headers=headers, timeout=30)
+        if resp.status_code == 404:
+            return None
+        resp.raise_for_status()
+    except requests.exceptions.RequestException as e:
+        log.warning("%s: Couldn't get the manifest from the registry: %s", image_nm, e)
+        return None
+
+    return resp.headers.get("Docker-Content-Digest")
+
+
+def push_image(image_nm: str) -> None:
+    """Push an image, logging the progress of its layers as it's streamed."""
+    for line in cli.images.push(image_nm, stream=True, decode=True):
+        if "error" in line:
+            raise docker.errors.APIError(line["error"])
+
+        status = line.get("status", "")
+        if "id" not in line:
+            log.info("%s: %s", image_nm, status)
+        elif any(status.startswith(s) for s in PUSH_STATUSES):
+            log.info("%s: %s %s", image_nm, line["id"], status)
+
+
+def retag_and_push_image(image_nm: str, retagged_image_nm: str, scheme: str) -> bool:
+    """Retag the image and push it, unless the registry already has it.
+
+    Returns:
+        Whether the image was pushed
+    """
+    img = get_or_pull_image(image_nm)
+    if retagged_image_nm != image_nm:
+        log.info("%s: Retagging to %s", image_nm, retagged_image_nm)
+        img.tag(retagged_image_nm)
+
+    # Docker records the digest of every manifest it pushed or pulled
+    digest = get_registry_digest(retagged_image_nm, scheme)
+    registry, repository, _ = split_image_name(retagged_image_nm)
+    repo_digest = "%s/%s@%s" % (registry, repository, digest)
+    if digest and repo_digest in img.attrs["RepoDigests"]:
+        log.info("%s: Registry already has %s. Skipping...", retagged_image_nm, digest)
+        return False
+
+    log.info("Pushing image: %s", retagged_image_nm)
+    push_image(retagged_image_nm)
+    return True
+
+
+def retag_and_push_images(images: dict[str, str], jobs: int, scheme: str) -> list[str]:
+    """Retag and push the images with a pool of workers.
+
+    Args:
+        images: Retagged name of every image, by image name
+        jobs: Number of images to retag and push concurrently
+        scheme: Scheme of the registry's API, http or https
+
+    Returns:
+        The images that failed, in the order of the list
+    """
+    images_len = len(images)
+    failed = set()
+    with ThreadPoolExecutor(max_workers=jobs) as executor:
+        futures = {
+            executor.submit(retag_and_push_image, image_nm, retagged_image_nm, scheme): image_nm
+            for image_nm, retagged_image_nm in images.items()
+        }
+        for idx, future in enumerate(as_completed(futures)):
+            image_nm = futures[future]
+            try:
+                pushed = future.result()
+                log.info(
+                    "%s/%s: %s %s",
+                    idx + 1,
+                    images_len,
+                    images[image_nm],
+                    "pushed" if pushed else "is in the registry",
+                )
+            except Exception as e:
+                log.error("%s/%s: Failed to push %s: %s", idx + 1, images_len, images[image_nm], e)
+                failed.add(image_nm)
+
+    return [image_nm for image_nm in images if image_nm in failed]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Retag list of images and push them to a registry")
+    parser.add_argument("images")
+    parser.add_argument("--new-registry", default="172.17.0.2:5000")
+    parser.add_argument("--retagged-images", default="retagged-images.txt")
+    parser.add_argument(
+        "-j", "--jobs", type=int, default=4, help="Number of images to retag and push concurrently"
+    )
+    parser.add_argument(
+        "--scheme",
+        choices=["http", "https"],
+        default="http",
+        help="Scheme of the registry's API, to check the images it already has",
+    )
+    args = parser.parse_args()
+    if args.jobs < 1:
+        parser.error("--jobs must be a positive integer")
+
+    # Each image is only pushed once, even if listed multiple times
+    images_ls = list(
+        dict.fromkeys(image for image in get_images_list_from_file(args.images) if image)
+    )
+    images = {
+        image_nm: get_retagged_image_name(image_nm, args.new_registry) for image_nm in images_ls
+    }
+
+    if all(image_nm == retagged_image_nm for image_nm, retagged_image_nm in images.items()):
+        # i.e. the list is retagged-images.txt itself, don't rewrite the input
+        log.info(
+            "All images are already named after %s, not saving the list of retagged images",
+            args.new_registry,
+        )
+    else:
+        with open(args.retagged_images, "w+") as f:
+            f.write("\n".join(images.values()))
+        log.info("Saved list of retagged images in '%s'", args.retagged_images)
+
+    failed_images = retag_and_push_images(images, args.jobs, args.scheme)
+    if failed_images:
+        log.error(
+            "Failed to push %s/%s images:\n%s",
+            len(failed_images),
+            len(images),
+            "\n".join(failed_images),
+        )
+        sys.exit(1)
+
+    log.info("Successfully pushed all images!")
@@ -4,14 +4,12 @@ import logging
 import docker
 
 from utils import (delete_file_if_exists, get_images_list_from_file,
-                   get_or_pull_image)
+                   get_or_pull_image, get_retagged_image_name)
 
 cli = docker.client.from_env()
 
 log = logging.getLogger(__name__)
 
-SHA_TOKEN = "@sha256"
-
 
 def retag_image_with_sha(image):
     """Retag the image by using the sha value."""
@@ -27,26 +25,6 @@ def retag_image_with_sha(image):
     return cli.images.get(tagged_image)
 
 
-def get_retagged_image_name(image_nm: str, new_registry: str) -> str:
-    """Given an image name replace the repo and use sha as tag."""
-    if SHA_TOKEN in image_nm:
-        log.info("Provided image has sha. Using it's value as tag.")
-        image_nm = image_nm.replace(SHA_TOKEN, "")
-
-    if len(image_nm.split("/")) == 1:
-        # docker.io/library image, i.e. ubuntu:22.04
-        return "%s/%s" % (new_registry, image_nm)
-
-    if len(image_nm.split("/")) == 2:
-        # classic docker.io image, i.e. argoproj/workflow-controller
-        return "%s/%s" % (new_registry, image_nm)
-
-    # There are more than 2 / in the image name. Replace first part
-    # Example image: quay.io/metallb/speaker:v0.13.3
-    _, image_nm = image_nm.split("/", 1)
-    return "%s/%s" % (new_registry, image_nm)
-
-
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="Retag list of images")
     parser.add_argument("images")
@@ -1,22 +1,72 @@
 import argparse
 import logging
+import sys
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
 import docker
 
-from utils import get_images_list_from_file, get_or_pull_image
+from utils import get_images_list_from_file, pull_image
 
 cli = docker.client.from_env()
 
 log = logging.getLogger(__name__)
 
 
+def pull_images(images: list[str], jobs: int, attempts: int) -> list[str]:
+    """Pull the images with a pool of workers, and return the failed ones."""
+    images_len = len(images)
+    failed = set()
+    with ThreadPoolExecutor(max_workers=jobs) as executor:
+        futures = {executor.submit(pull_image, image, attempts): image for image in images}
+        for idx, future in enumerate(as_completed(futures)):
+            image = futures[future]
+            try:
+                future.result()
+                log.info("%s/%s: %s is in cache", idx + 1, images_len, image)
+            except Exception as e:
+                log.error("%s/%s: Failed to pull %s: %s", idx + 1, images_len, image, e)
+                failed.add(image)
+
+    # Report the failures in the order of the list
+    return [image for image in images if image in failed]
+
+
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="Pull locally list of images")
     parser.add_argument("images")
+    parser.add_argument(
+        "-j", "--jobs", type=int, default=4, help="Number of images to pull concurrently"
+    )
+    parser.add_argument(
+        "--attempts", type=int, default=3, help="Number of attempts to pull each image"
+    )
+    parser.add_argument(
+        "--failed-images",
+        default="failed-images.txt",
+        help="File to write the images that failed to",
+    )
     args = parser.parse_args()
+    if args.jobs < 1:
+        parser.error("--jobs must be a positive integer")
+    if args.attempts < 1:
+        parser.error("--attempts must be a positive integer")
+
+    # Each image is only pulled once, even if listed multiple times
+    images_ls = list(
+        dict.fromkeys(image for image in get_images_list_from_file(args.images) if image)
+    )
+    failed_images = pull_images(images_ls, args.jobs, args.attempts)
+
+    if failed_images:
+        log.error(
+            "Failed to pull %s/%s images:\n%s",
+            len(failed_images),
+            len(images_ls),
+            "\n".join(failed_images),
+        )
+        with open(args.failed_images, "w+") as f:
+            f.write("\n".join(failed_images))
+        log.error("Saved the list of failed images in '%s'", args.failed_images)
+        sys.exit(1)
 
-    images_ls = get_images_list_from_file(args.images)
-    images_len = len(images_ls)
-    for idx, image in enumerate(images_ls):
-        log.info("%s/%s", idx + 1, images_len)
-        get_or_pull_image(image)
+    log.info("Successfully pulled all images!")
@@ -1,65 +1,269 @@
 import argparse
+import hashlib
 import logging
 import os
 import subprocess
+import sys
 
 import docker
 
-from utils import (delete_file_if_exists, get_images_list_from_file,
-                   get_or_pull_image)
+from utils import (CHUNK_SIZE, MANIFEST_NAME, delete_file_if_exists,
+                   get_file_sha256, get_images_list_from_file,
+                   get_or_pull_image, is_file_intact, load_manifest,
+                   save_manifest)
 
 cli = docker.client.from_env()
 
 log = logging.getLogger(__name__)
 
+ARCHIVE_NAME = "images.tar.gz"
+# We've seen that sometimes we get socket timeouts from `docker save`
+SAVE_ATTEMPTS = 10
 
-def save_image(image_nm) -> str:
-    """Given an Image object, save it as tar."""
-    get_or_pull_image(image_nm)
+
+def get_tar_name(image_nm) -> str:
+    """Return the name of the tar of a single image."""
     file_name = "%s.tar" % image_nm
-    file_name = file_name.replace("/", "-").replace(":", "-")
-    if os.path.isfile(file_name):
-        log.info("Tar '%s' already exists. Skipping...", file_name)
+    return file_name.replace("/", "-").replace(":", "-")
+
+
+def get_file_entry(file_name) -> dict:
+    """Return the manifest entry of a file, with its size and sha256."""
+    return {"file": file_name,
+            "size": os.path.getsize(file_name),
+            "sha256": get_file_sha256(file_name)}
+
+
+def is_image_current(image_nm, digest) -> bool:
+    """Return whether the image in cache, if any, still has this digest."""
+    try:
+        return cli.images.get(image_nm).id == digest
+    except docker.errors.ImageNotFound:
+        # Nothing newer to save, no need to pull the image again
+        return True
+
+
+def is_image_saved(image_nm, entry) -> bool:
+    """Return whether the tar of the image is complete and up to date."""
+    if not entry or not is_file_intact(entry["file"], entry["size"],
+                                       entry["sha256"]):
+        return False
+    return is_image_current(image_nm, entry["digest"])
+
+
+def run_to_file(commands: list[list[str]], file_name) -> dict:
+    """Run a pipeline of commands and write its output to a file.
+
+    The output is hashed while it's written, and only moved to file_name once
+    all the commands succeeded, so that a failed run never leaves a partial
+    file behind.
+
+    Returns:
+        The manifest entry of the file, with its size and sha256
+    """
+    procs = []
+    stdout = None
+    for command in commands:
+        proc = subprocess.Popen(command, stdin=stdout, stdout=subprocess.PIPE)
+        if stdout is not None:
+            # Leave the pipe to the next command, so that it sees the end of it
+            stdout.close()
+        stdout = proc.stdout
+        procs.append(proc)
+
+    part_name = "%s.part" % file_name
+    sha256 = hashlib.sha256()
+    size = 0
+    try:
+        with open(part_name, "wb") as f:
+            for chunk in iter(lambda: stdout.read(CHUNK_SIZE), b""):
+                f.write(chunk)
+                sha256.update(chunk)
+                size += len(chunk)
+    except BaseException:
+        # i.e. the disk is full, nothing reads the pipeline anymore
+        for proc in procs:
+            proc.kill()
+        delete_file_if_exists(part_name)
+        raise
+    finally:
+        stdout.close()
+        for proc in procs:
+            proc.wait()
+
+    for proc in procs:
+        if proc.returncode != 0:
+            delete_file_if_exists(part_name)
+            raise subprocess.CalledProcessError(proc.returncode, proc.args)
+
+    os.replace(part_name, file_name)
+    return {"file": file_name, "size": size, "sha256": sha256.hexdigest()}
+
+
+def save_image(image_nm, manifest: dict) -> str:
+    """Save an image as tar, unless an intact tar of it is in the manifest."""
+    file_name = get_tar_name(image_nm)
+    if is_image_saved(image_nm, manifest["images"].get(image_nm)):
+        log.info("Tar '%s' already saved. Skipping...", file_name)
         return file_name
 
+    img = get_or_pull_image(image_nm)
     log.info("%s: Saving image to tar '%s'.", image_nm, file_name)
-    for i in range(10):
-        # We've seen that sometimes we get socket timeouts. Try 10 times
+    for i in range(SAVE_ATTEMPTS):
         try:
-            with open(file_name, "w+b") as f:
-                subprocess.run(["docker", "save", image_nm], stdout=f)
+            entry = run_to_file([["docker", "save", image_nm]], file_name)
+            manifest["images"][image_nm] = {"digest": img.id, **entry}
 
-            logging.info("%s: Saved image to tar '%s'", image_nm, file_name)
+            log.info("%s: Saved image to tar '%s'", image_nm, file_name)
             return file_name
         except Exception as e:
-            log.error("Failed to create tar file. Deleting tar '%s", file_name)
+            log.error("Failed to create tar file '%s'", file_name)
             log.error(e)
-            log.info("Retrying %s/10 to store image to tar '%s'",
-                     i + 1, file_name)
+            log.info("Retrying %s/%s to store image to tar '%s'",
+                     i + 1, SAVE_ATTEMPTS, file_name)
 
-    log.error("Tried 10 times to create tar '%s' and failed: %s", file_name)
-    delete_file_if_exists(file_name)
+    log.error("Tried %s times to create tar '%s' and failed", SAVE_ATTEMPTS,
+              file_name)
+    raise RuntimeError("Failed to save image %s" % image_nm)
 
 
-if __name__ == "__main__":
-    parser = argparse.ArgumentParser(description="Create tar.gz from images")
-    parser.add_argument("images")
-    args = parser.parse_args()
+def save_images_per_image(images_ls: list[str], manifest: dict,
+                          manifest_name) -> None:
+    """Save every image in its own tar, and compress them all together.
 
-    images_ls = get_images_list_from_file(args.images)
+    The manifest is saved after every image, so that a resumed run only saves
+    the images whose tar is missing or corrupted.
+    """
     images_len = len(images_ls)
     tar_files = []
     for idx, image_nm in enumerate(images_ls):
         log.info("%s/%s", idx + 1, images_len)
-        tar_file = save_image(image_nm)
+        tar_file = save_image(image_nm, manifest)
         tar_files.append(tar_file)
+        save_manifest(manifest, manifest_name)
 
     log.info("Creating final tar.gz file. Will take a while...")
-    subprocess.run(["tar", "-cv", "--use-compress-program=pigz",
-                    "-f", "images.tar.gz", *tar_files])
+    manifest["archive"] = run_to_file(
+        [["tar", "-cv", "--use-compress-program=pigz", "-f", "-",
+          *tar_files]],
+        ARCHIVE_NAME)
     log.info("Created the tar.gz file!")
 
     log.info("Deleting intermediate .tar files.")
     for file in tar_files:
         delete_file_if_exists(file)
     log.info("Deleted all .tar files.")
+
+
+def save_archive(images_ls: list[str], stream: bool) -> dict:
+    """Save all the images with a single `docker save`, and compress them.
+
+    Returns:
+        The manifest entry of the archive, with its size and sha256
+    """
+    if stream:
+        log.info("Streaming all images to '%s'. Will take a while...",
+                 ARCHIVE_NAME)
+        return run_to_file([["docker", "save", *images_ls], ["pigz"]],
+                           ARCHIVE_NAME)
+
+    tar_file = ARCHIVE_NAME.removesuffix(".gz")
+    log.info("Saving all images to tar '%s'. Will take a while...", tar_file)
+    delete_file_if_exists(tar_file)
+    subprocess.run(["docker", "save", "-o", tar_file, *images_ls], check=True)
+
+    log.info("Compressing '%s' to '%s'.", tar_file, ARCHIVE_NAME)
+    subprocess.run(["pigz", "-f", tar_file], check=True)
+    return get_file_entry(ARCHIVE_NAME)
+
+
+def save_images_archive(images_ls: list[str], manifest: dict,
+                        stream: bool) -> None:
+    """Save all the images in a single archive, and compress it.
+
+    A single `docker save` of all the images writes every layer once, even
+    if it is shared by many images, i.e. the ubuntu and python base layers.
+    Docker 25 and later write it as an OCI image layout.
+
+    When streaming, the output of `docker save` is compressed on the fly, so
+    that no intermediate tar is written to disk.
+    """
+    images_len = len(images_ls)
+    for idx, image_nm in enumerate(images_ls):
+        log.info("%s/%s", idx + 1, images_len)
+        img = get_or_pull_image(image_nm)
+        manifest["images"][image_nm] = {"digest": img.id}
+
+    for i in range(SAVE_ATTEMPTS):
+        try:
+            manifest["archive"] = save_archive(images_ls, stream)
+            log.info("Created the tar.gz file!")
+            return
+        except Exception as e:
+            log.error("Failed to create '%s'", ARCHIVE_NAME)
+            log.error(e)
+            log.info("Retrying %s/%s to save all images to '%s'",
+                     i + 1, SAVE_ATTEMPTS, ARCHIVE_NAME)
+
+    log.error("Tried %s times to create '%s' and failed", SAVE_ATTEMPTS,
+              ARCHIVE_NAME)
+    raise RuntimeError("Failed to save the images to %s" % ARCHIVE_NAME)
+
+
+def is_archive_saved(images_ls: list[str], manifest: dict) -> bool:
+    """Return whether the archive in the manifest is intact and up to date.
+
+    It's up to date if it has exactly the images of the list, and none of
+    them changed in cache since it was saved.
+    """
+    archive = manifest.get("archive")
+    if not archive or set(manifest["images"]) != set(images_ls):
+        return False
+    if not is_file_intact(archive["file"], archive["size"], archive["sha256"]):
+        return False
+    return all(is_image_current(image_nm, entry["digest"])
+               for image_nm, entry in manifest["images"].items())
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Create tar.gz from images")
+    parser.add_argument("images")
+    parser.add_argument("--layout", choices=["oci", "per-image"],
+                        default="oci",
+                        help="Save all images in a single archive, with "
+                             "shared layers stored once (oci), or every "
+                             "image in its own tar (per-image)")
+    parser.add_argument("--stream", action="store_true",
+                        help="Compress the images on the fly, without "
+                             "writing an intermediate tar to disk")
+    parser.add_argument("--manifest", default=MANIFEST_NAME,
+                        help="File recording the digest, size and sha256 "
+                             "of the saved images, to resume from")
+    args = parser.parse_args()
+    if args.stream and args.layout != "oci":
+        # tar needs the size of each file up front, which the output of
+        # `docker save` doesn't tell until it's written
+        parser.error("--stream is only supported with --layout=oci")
+
+    images_ls = get_images_list_from_file(args.images)
+    manifest = load_manifest(args.manifest)
+    if manifest.get("layout") != args.layout:
+        # Nothing to resume from a different layout
+        manifest = {"layout": args.layout, "images": {}}
+
+    if is_archive_saved(images_ls, manifest):
+        log.info("'%s' is already up to date. Skipping...",
+                 manifest["archive"]["file"])
+        sys.exit(0)
+
+    manifest.pop("archive", None)
+    manifest["images"] = {image_nm: entry
+                          for image_nm, entry in manifest["images"].items()
+                          if image_nm in images_ls}
+    delete_file_if_exists(ARCHIVE_NAME)
+    if args.layout == "oci":
+        save_images_archive(images_ls, manifest, args.stream)
+    else:
+        save_images_per_image(images_ls, manifest, args.manifest)
+    save_manifest(manifest, args.manifest)
+    log.info("Saved the manifest of the images to '%s'.", args.manifest)
@@ -1,12 +1,19 @@
+import hashlib
+import json
 import logging
 import os
 import pathlib
+import time
 
 import docker
+import requests
 
 cli = docker.client.from_env()
 
 LOG_FORMAT = "%(levelname)s \t| %(message)s"
+MANIFEST_NAME = "images-manifest.json"
+CHUNK_SIZE = 1024 * 1024
+SHA_TOKEN = "@sha256"
 logging.basicConfig(format=LOG_FORMAT, level=logging.INFO)
 
 log = logging.getLogger(__name__)
@@ -39,6 +46,30 @@ def get_images_list_from_file(file_name: str) -> list[str]:
         return []
 
 
+def get_retagged_image_name(image_nm: str, new_registry: str) -> str:
+    """Given an image name replace the repo and use sha as tag."""
+    if image_nm.startswith("%s/" % new_registry):
+        # Already retagged, i.e. listed in retagged-images.txt
+        return image_nm
+
+    if SHA_TOKEN in image_nm:
+        log.info("Provided image has sha. Using it's value as tag.")
+        image_nm = image_nm.replace(SHA_TOKEN, "")
+
+    if len(image_nm.split("/")) == 1:
+        # docker.io/library image, i.e. ubuntu:22.04
+        return "%s/%s" % (new_registry, image_nm)
+
+    if len(image_nm.split("/")) == 2:
+        # classic docker.io image, i.e. argoproj/workflow-controller
+        return "%s/%s" % (new_registry, image_nm)
+
+    # There are more than 2 / in the image name. Replace first part
+    # Example image: quay.io/metallb/speaker:v0.13.3
+    _, image_nm = image_nm.split("/", 1)
+    return "%s/%s" % (new_registry, image_nm)
+
+
 def get_or_pull_image(image: str):
     """First try to get the image from local cache, and then pull."""
     try:
@@ -53,3 +84,63 @@ def get_or_pull_image(image: str):
 
         log.info("%s: Pulled image", image)
         return img
+
+
+def pull_image(image: str, attempts: int = 3, backoff: float = 5):
+    """Get or pull the image, retrying failed pulls with exponential backoff.
+
+    Pulls fail on socket timeouts and registry errors, i.e. rate limiting, so
+    every retry waits twice as long as the previous one.
+    """
+    for attempt in range(1, attempts + 1):
+        try:
+            return get_or_pull_image(image)
+        except docker.errors.NotFound:
+            # The image doesn't exist, retrying won't help
+            raise
+        except (docker.errors.DockerException, requests.exceptions.RequestException) as e:
+            if attempt == attempts:
+                raise
+
+            delay = backoff * 2 ** (attempt - 1)
+            log.warning(
+                "%s: Attempt %s/%s failed: %s. Retrying in %ss", image, attempt, attempts, e, delay
+            )
+            time.sleep(delay)
+
+
+def get_file_sha256(file_name) -> str:
+    """Return the hex sha256 of a file, read in chunks."""
+    sha256 = hashlib.sha256()
+    with open(file_name, "rb") as f:
+        for chunk in iter(lambda: f.read(CHUNK_SIZE), b""):
+            sha256.update(chunk)
+    return sha256.hexdigest()
+
+
+def is_file_intact(file_name, size: int, sha256: str) -> bool:
+    """Return whether the file exists, with the given size and sha256."""
+    if not os.path.isfile(file_name) or os.path.getsize(file_name) != size:
+        return False
+    return get_file_sha256(file_name) == sha256
+
+
+def load_manifest(file_name) -> dict:
+    """Load the manifest of the images archive, empty if it doesn't exist."""
+    try:
+        with open(file_name) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {}
+
+
+def save_manifest(manifest: dict, file_name) -> None:
+    """Save the manifest of the images archive.
+
+    It's written to a temporary file first, so that a crash never leaves a
+    half-written manifest behind.
+    """
+    part_name = "%s.part" % file_name
+    with open(part_name, "w") as f:
+        json.dump(manifest, f, indent=2)
+    os.replace(part_name, file_name)
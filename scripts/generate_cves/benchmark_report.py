@@ -0,0 +1,249 @@
+#!/usr/bin/env python3
+"""Micro-benchmarks for the report generation of produce_vulnerability_report.py.
+
+The benchmarks run on synthetic Trivy findings, so they need neither Trivy
+nor the real exceptions and tickets files.
+"""
+
+import argparse
+import logging
+import random
+import sys
+import time
+import typing
+
+import pandas as pd
+
+from produce_vulnerability_report import (
+    ExceptionIndex,
+    merge_cve,
+    scan_images,
+)
+
+logging.basicConfig(stream=sys.stdout, level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+SEVERITIES = ["LOW", "MEDIUM", "HIGH", "CRITICAL", "UNKNOWN"]
+RATIONALES = [
+    "Not reachable from the charm",
+    "Only affects Windows builds",
+    "Waiting for an upstream fix",
+    "Test dependency, not shipped",
+]
+
+
+def synthetic_scans(
+    findings: int, images: int = 50, cves: int = 3000, seed: int = 0
+) -> list[tuple[str, dict]]:
+    """Generate Trivy reports holding the given number of findings in total.
+
+    Args:
+        findings: Number of vulnerabilities across all the reports
+        images: Number of images to spread the findings over
+        cves: Number of distinct CVEs to draw the findings from
+        seed: Seed of the random generator
+
+    Returns:
+        List of (image name, Trivy report) pairs, as yielded by iter_reports
+    """
+    rng = random.Random(seed)
+    scans = []
+    for index in range(images):
+        vulnerabilities = []
+        for _ in range(findings // images):
+            cve = f"CVE-2024-{rng.randrange(cves):05d}"
+            vulnerabilities.append(
+                {
+                    "VulnerabilityID": cve,
+                    "PkgName": f"pkg{rng.randrange(100)}",
+                    "InstalledVersion": "1.0",
+                    "FixedVersion": rng.choice(["", "1.1ubuntu2", "2.0"]),
+                    "Severity": rng.choice(SEVERITIES),
+                    "CVSS": {"nvd": {"V3Score": round(rng.uniform(1, 10), 1)}},
+                    "Title": f"Title of {cve}",
+                    "Description": f"Description of {cve}",
+                }
+            )
+        image = f"charmedkubeflow/image{index}:1.{index}"
+        scans.append((image, {"Results": [{"Vulnerabilities": vulnerabilities}]}))
+    return scans
+
+
+def synthetic_exceptions(
+    scans: list[tuple[str, dict]], ratio: float = 0.3, seed: int = 0
+) -> dict[str, dict[str, str]]:
+    """Pick a share of the CVEs of the scans and give them exceptions.
+
+    Each selected CVE gets an exception for half of its images, so that the
+    other half fall back to the most common rationale.
+
+    Returns:
+        Rationale of the exceptions, structured as { <CVE>: { <IMAGE>: <RATIONALE> } }
+    """
+    rng = random.Random(seed)
+    images_by_cve = {}
+    for image_name, data in scans:
+        for result in data["Results"]:
+            for vulnerability in result["Vulnerabilities"]:
+                images_by_cve.setdefault(vulnerability["VulnerabilityID"], set()).add(
+                    image_name.split(":")[0]
+                )
+
+    rationales = {}
+    for cve, images in sorted(images_by_cve.items()):
+        if rng.random() < ratio:
+            rationales[cve] = {
+                image: rng.choice(RATIONALES) for image in sorted(images) if rng.random() < 0.5
+            }
+    return rationales
+
+
+def synthetic_tickets(
+    scans: list[tuple[str, dict]], ratio: float = 0.2, seed: int = 0
+) -> dict[str, dict[str, str]]:
+    """Give tickets to a share of the (CVE, image) pairs of the scans.
+
+    Returns:
+        Tickets remediating the CVEs, structured as { <CVE>: { <IMAGE>: <TICKET> } }
+    """
+    rng = random.Random(seed)
+    tickets = {}
+    for image_name, data in scans:
+        for result in data["Results"]:
+            for vulnerability in result["Vulnerabilities"]:
+                if rng.random() < ratio:
+                    tickets.setdefault(vulnerability["VulnerabilityID"], {})[
+                        image_name.split(":")[0]
+                    ] = f"KF-{rng.randrange(50)}"
+    return tickets
+
+
+def most_common_rationale(exception: dict[str, str]) -> str:
+    # Fallback rationale as computed for every vulnerability before the
+    # exceptions were indexed, kept here as the reference
+    return pd.Series(exception).value_counts().sort_values(ascending=False).head(1).index[0]
+
+
+def build_exception_index(rationales: dict[str, dict[str, str]]) -> ExceptionIndex:
+    # Same index as get_exceptions builds from the exceptions file
+    return ExceptionIndex(
+        rationales,
+        {
+            cve: most_common_rationale(exception)
+            for cve, exception in rationales.items()
+            if exception
+        },
+    )
+
+
+def timed(func: typing.Callable, *args) -> tuple[typing.Any, float]:
+    start = time.perf_counter()
+    result = func(*args)
+    return result, time.perf_counter() - start
+
+
+def bench_exceptions(scans: list[tuple[str, dict]]) -> None:
+    """Compare the per-vulnerability fallback rationale with the precomputed index."""
+    rationales = synthetic_exceptions(scans)
+    pairs = [
+        (vulnerability["VulnerabilityID"], image_name.split(":")[0])
+        for image_name, data in scans
+        for result in data["Results"]
+        for vulnerability in result["Vulnerabilities"]
+    ]
+
+    def per_vulnerability():
+        return [
+            rationales[cve].get(image) or f"(Possible) {most_common_rationale(rationales[cve])}"
+            for cve, image in pairs
+            if rationales.get(cve)
+        ]
+
+    def indexed(index):
+        return [
+            index.rationales[cve].get(image) or f"(Possible) {index.most_common[cve]}"
+            for cve, image in pairs
+            if cve in index.most_common
+        ]
+
+    expected, legacy_time = timed(per_vulnerability)
+    index, build_time = timed(build_exception_index, rationales)
+    result, lookup_time = timed(indexed, index)
+    if result != expected:
+        raise RuntimeError("Indexed rationales differ from the per-vulnerability ones")
+
+    logger.info(
+        f"Exception rationales for {len(expected)} vulnerabilities: "
+        f"per vulnerability {legacy_time:.2f}s, "
+        f"index {build_time:.2f}s to build + {lookup_time:.3f}s to look up"
+    )
+
+    _, report_time = timed(scan_images, iter(scans), set(), index, None, {})
+    logger.info(f"scan_images with the exception index: {report_time:.2f}s")
+
+
+def reduce_merge_cve(input_df: pd.DataFrame) -> pd.DataFrame:
+    # merge_cve as implemented before the aggregation, with a Python reducer
+    # per CVE, kept here as the reference
+
+    def reduce(subset: pd.DataFrame):
+        components = ",".join(subset["Affected Component"].values)
+        tickets = ",".join(
+            {ticket for ticket in subset["Ticket"].values if ticket and isinstance(ticket, str)}
+        )
+        row = subset.iloc[0].copy(deep=True)
+        row["Affected Component"] = components
+        row["Ticket"] = tickets
+        return row
+
+    return input_df.groupby("CVE").apply(reduce, include_groups=False)
+
+
+def bench_merge_cve(scans: list[tuple[str, dict]]) -> None:
+    """Compare merge_cve with the per-CVE reducer it replaced."""
+    index = build_exception_index(synthetic_exceptions(scans))
+    cve_list = scan_images(iter(scans), set(), index, None, synthetic_tickets(scans))
+
+    expected, legacy_time = timed(reduce_merge_cve, cve_list)
+    result, merge_time = timed(merge_cve, cve_list)
+
+    # The reducer joins the tickets of a CVE from a set, in no particular order
+    def sort_tickets(df):
+        return df.assign(Ticket=df["Ticket"].map(lambda t: sorted(t.split(","))))
+
+    pd.testing.assert_frame_equal(sort_tickets(expected), sort_tickets(result), check_names=False)
+
+    logger.info(
+        f"merge_cve of {len(cve_list)} vulnerabilities into {len(result)} CVEs: "
+        f"reducer {legacy_time:.2f}s, aggregation {merge_time:.2f}s"
+    )
+
+
+BENCHMARKS = {
+    "exceptions": bench_exceptions,
+    "merge": bench_merge_cve,
+}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument(
+        "-b",
+        "--benchmark",
+        action="append",
+        dest="benchmarks",
+        choices=list(BENCHMARKS),
+        help="A benchmark to run, may be repeated. Runs all of them by default.",
+    )
+    parser.add_argument(
+        "--findings",
+        type=int,
+        default=50000,
+        help="The number of synthetic findings to generate. Defaults to 50000.",
+    )
+    args = parser.parse_args()
+
+    logger.info(f"Generating {args.findings} synthetic findings")
+    scans = synthetic_scans(args.findings)
+    for name in args.benchmarks or BENCHMARKS:
+        BENCHMARKS[name](scans)
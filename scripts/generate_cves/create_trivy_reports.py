@@ -1,15 +1,94 @@
 #!/usr/bin/env python3
 import argparse
+import contextlib
+import json
 import logging
 import subprocess
 import sys
+import threading
 import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from dataclasses import dataclass
 from pathlib import Path
 
+import tenacity
+
+from utils import (
+    TRIVY_REPORT_TYPE,
+    ensure_positive_int,
+    get_report_path,
+    group_images_by_digest,
+    resolve_image_digest,
+    trivy_server,
+    write_atomic,
+)
+
 
-TRIVY_REPORT_TYPE = "json"
 TRIVY_TIMEOUT = "10m"
 TRIVY_SKIP_FILES = "/bin/pebble,/usr/bin/pebble,usr/bin/pebble,bin/pebble"
+TRIVY_ATTEMPTS = 3
+# The index is not named *.json, as the report folder is expected to only
+# contain Trivy reports with that extension
+CACHE_INDEX_FILE = ".trivy-cache-index"
+CACHE_TTL_HOURS = 24
+
+
+@dataclass
+class ScanResult:
+    """Outcome of scanning a single image."""
+
+    image: str
+    report_path: Path
+    duration: float
+    error: str | None = None
+    cached: bool = False
+
+
+class ReportCache:
+    """Index of the reports produced by previous runs.
+
+    Every entry records the image digest, Trivy DB version and scan options
+    a report was produced with, and when. A report is reused as long as none
+    of them changed, and it is not older than the TTL.
+    """
+
+    def __init__(self, index_path: Path, db_version: str | None, ttl_hours: float):
+        self.index_path = index_path
+        self.db_version = db_version
+        self.ttl_seconds = ttl_hours * 3600
+        self.options = get_scan_options()
+        self._lock = threading.Lock()
+        self._entries = {}
+        if index_path.is_file():
+            self._entries = json.loads(index_path.read_text())
+
+    def is_fresh(self, image: str, digest: str | None, report_path: Path) -> bool:
+        """Return whether the report of an image can be reused."""
+        entry = self._entries.get(image)
+        if not entry or not report_path.is_file():
+            return False
+        if digest is None or self.db_version is None:
+            return False
+        return (
+            entry["digest"] == digest
+            and entry["db_version"] == self.db_version
+            and entry["options"] == self.options
+            and entry["report"] == str(report_path)
+            and time.time() - entry["timestamp"] < self.ttl_seconds
+        )
+
+    def record(self, image: str, digest: str | None, report_path: Path) -> None:
+        """Record a new report of an image, and save the index."""
+        with self._lock:
+            self._entries[image] = {
+                "digest": digest,
+                "db_version": self.db_version,
+                "options": self.options,
+                "report": str(report_path),
+                "timestamp": time.time(),
+            }
+            # Save after every scan, so that interrupted runs can resume
+            write_atomic(self.index_path, json.dumps(self._entries, indent=2, sort_keys=True))
 
 
 def configure_logging(verbose: bool) -> None:
@@ -20,11 +99,6 @@ def configure_logging(verbose: bool) -> None:
     )
 
 
-def normalize_image_name(image: str) -> str:
-    """Normalize the image of the image to avoid difficult characters."""
-    return image.replace(":", "-").replace("/", "-").replace(".", "-")
-
-
 def ensure_file_path(file: str):
     """Ensure a given file path actually exists."""
     image_file = Path(file)
@@ -40,8 +114,49 @@ def ensure_dir_path(directory: str):
     return output_dir
 
 
-def run_trivy(image: str, report_path: Path) -> None:
-    """Run trivy scan for an image file, and output to report_path."""
+def get_scan_options() -> str:
+    """Return the options that affect the content of a report."""
+    return f"format={TRIVY_REPORT_TYPE};skip-files={TRIVY_SKIP_FILES}"
+
+
+def get_trivy_db_version() -> str | None:
+    """Update the Trivy vulnerability DB if needed, and return its version."""
+    try:
+        subprocess.run(
+            ["trivy", "image", "--download-db-only", "-q"],
+            capture_output=True,
+            text=True,
+            check=True,
+        )
+        result = subprocess.run(
+            ["trivy", "version", "--format", "json"],
+            capture_output=True,
+            text=True,
+            check=True,
+        )
+        db = json.loads(result.stdout)["VulnerabilityDB"]
+        return f"{db['Version']}-{db['UpdatedAt']}"
+    except (subprocess.CalledProcessError, json.JSONDecodeError, KeyError) as e:
+        logging.warning(f"Could not get the Trivy DB version, reports won't be reused: {e}")
+        return None
+
+
+@tenacity.retry(
+    stop=tenacity.stop_after_attempt(TRIVY_ATTEMPTS),
+    wait=tenacity.wait_exponential(multiplier=5, max=60),
+    before_sleep=lambda state: logging.warning(
+        f"Retrying scan after attempt {state.attempt_number} failed: "
+        f"{state.outcome.exception()}"
+    ),
+    reraise=True,
+)
+def run_trivy(image: str, report_path: Path, server: str | None = None) -> None:
+    """Run trivy scan for an image file, and output to report_path.
+
+    The report is written to report_path only once the scan succeeded, so
+    that a report only exists once it is complete. If a server URL is given,
+    the scan uses the vulnerability DB of that server.
+    """
     cmd = [
         "trivy",
         "image",
@@ -49,13 +164,13 @@ def run_trivy(image: str, report_path: Path) -> None:
         "-q",
         "--format",
         TRIVY_REPORT_TYPE,
-        "-o",
-        str(report_path),
         "--timeout",
         TRIVY_TIMEOUT,
         "--skip-files",
         TRIVY_SKIP_FILES,
     ]
+    if server:
+        cmd += ["--server", server]
     logging.debug(f"Executing command: {' '.join(cmd)}")
     start = time.time()
     result = subprocess.run(
@@ -70,11 +185,100 @@ def run_trivy(image: str, report_path: Path) -> None:
         if result.stderr:
             logging.error(f"stderr:\n{result.stderr.strip()}")
         raise RuntimeError(f"Trivy failed for {image}")
+    write_atomic(report_path, result.stdout)
     logging.info(f"Scan completed for {image} in {duration:.2f}")
     if result.stderr:
         logging.debug(f"Trivy stderr:\n{result.stderr.strip()}")
 
 
+def scan_image(
+    image: str,
+    output_dir: Path,
+    cache: ReportCache | None = None,
+    server: str | None = None,
+    digest: str | None = None,
+) -> ScanResult:
+    """Scan an image into output_dir, and return the outcome of the scan.
+
+    If a cache is given, the scan is skipped when the existing report of the
+    image is still fresh.
+    """
+    report_path = get_report_path(image, output_dir)
+    start = time.time()
+    if cache and digest is None:
+        digest = resolve_image_digest(image)
+    if cache and cache.is_fresh(image, digest, report_path):
+        logging.info(f"Report for {image} is up to date, skipping scan")
+        return ScanResult(image, report_path, time.time() - start, cached=True)
+
+    logging.info(f"Scanning image {image} → {report_path}")
+    try:
+        run_trivy(image, report_path, server)
+    except Exception as e:
+        logging.error(f"Execution failed: {e}")
+        return ScanResult(image, report_path, time.time() - start, str(e))
+    if cache:
+        cache.record(image, digest, report_path)
+    return ScanResult(image, report_path, time.time() - start)
+
+
+def write_alias_reports(
+    result: ScanResult,
+    aliases: list[str],
+    output_dir: Path,
+    cache: ReportCache | None = None,
+    digest: str | None = None,
+) -> None:
+    """Copy the report of a scanned image to the other references of the image.
+
+    Each copy has its ArtifactName set to its own reference, as expected by
+    produce_vulnerability_report.py.
+    """
+    if result.error or not aliases:
+        return
+    report = json.loads(result.report_path.read_text())
+    for alias in aliases:
+        report_path = get_report_path(alias, output_dir)
+        report["ArtifactName"] = alias
+        write_atomic(report_path, json.dumps(report, indent=2))
+        logging.info(f"Report of {result.image} copied for {alias} → {report_path}")
+        if cache:
+            cache.record(alias, digest, report_path)
+
+
+def scan_image_group(
+    digest: str,
+    images: list[str],
+    output_dir: Path,
+    cache: ReportCache | None = None,
+    server: str | None = None,
+) -> ScanResult:
+    """Scan the first of a group of references to the same image, and copy
+    its report to the others."""
+    # Groups of references that could not be resolved are keyed by reference
+    digest = digest if digest.startswith("sha256:") else None
+    result = scan_image(images[0], output_dir, cache, server, digest)
+    write_alias_reports(result, images[1:], output_dir, cache, digest)
+    return result
+
+
+def log_summary(results: list[ScanResult]) -> None:
+    """Log a table with the outcome and duration of every scan."""
+    width = max(len(result.image) for result in results)
+    logging.info(f"{'Image':<{width}} | {'Status':<7} | Duration")
+    logging.info(f"{'-' * width}-+-{'-' * 7}-+-{'-' * 8}")
+    for result in sorted(results, key=lambda result: result.image):
+        status = "FAILED" if result.error else "CACHED" if result.cached else "OK"
+        logging.info(f"{result.image:<{width}} | {status:<7} | {result.duration:7.2f}s")
+
+    failed = sum(1 for result in results if result.error)
+    cached = sum(1 for result in results if result.cached)
+    logging.info(
+        f"{len(results) - failed - cached} scans succeeded, {failed} failed, "
+        f"{cached} reports reused."
+    )
+
+
 def main():
     """Receive image list as an argument, and output"""
     parser = argparse.ArgumentParser(
@@ -88,6 +292,34 @@ def main():
         help="Directory where trivy reports will be stored (default: trivy-reports)",
         type=ensure_dir_path
     )
+    parser.add_argument(
+        "-p",
+        "--parallel",
+        default=1,
+        help="Number of images to scan concurrently (default: 1)",
+        type=ensure_positive_int,
+    )
+    parser.add_argument(
+        "--cache-ttl",
+        default=CACHE_TTL_HOURS,
+        help=f"Hours after which existing reports are rescanned (default: {CACHE_TTL_HOURS})",
+        type=float,
+    )
+    parser.add_argument(
+        "--no-cache",
+        action="store_true",
+        help="Rescan all images, even if their existing reports are still fresh",
+    )
+    server_group = parser.add_mutually_exclusive_group()
+    server_group.add_argument(
+        "--trivy-server",
+        help="URL of a running Trivy server to scan images with",
+    )
+    server_group.add_argument(
+        "--start-trivy-server",
+        action="store_true",
+        help="Start a local Trivy server for the duration of the run, and scan images with it",
+    )
     parser.add_argument(
         "--verbose",
         action="store_true",
@@ -100,16 +332,41 @@ def main():
     images = [
         line.strip() for line in args.file.read_text().splitlines() if line.strip()
     ]
+    if not images:
+        logging.info("No images to scan.")
+        return 0
+
+    cache = None
+    if not args.no_cache:
+        # The DB of a remote server is unknown, its reports only expire with the TTL
+        db_version = (
+            f"server {args.trivy_server}" if args.trivy_server else get_trivy_db_version()
+        )
+        cache = ReportCache(args.output / CACHE_INDEX_FILE, db_version, args.cache_ttl)
+
+    # Each scan is a separate trivy process, the threads only wait on them
+    results = []
+    with contextlib.ExitStack() as stack, ThreadPoolExecutor(
+        max_workers=args.parallel
+    ) as executor:
+        server = args.trivy_server
+        if args.start_trivy_server:
+            server = stack.enter_context(trivy_server())
+        groups = group_images_by_digest(images, args.parallel)
+        futures = [
+            executor.submit(
+                scan_image_group, digest, group, args.output, cache, server
+            )
+            for digest, group in groups.items()
+        ]
+        for idx, future in enumerate(as_completed(futures), start=1):
+            result = future.result()
+            results.append(result)
+            logging.info(f"[{idx}/{len(groups)}] Finished scanning {result.image}")
 
-    for image in images:
-        normalized = normalize_image_name(image)
-        report_path = args.output / f"{normalized}.{TRIVY_REPORT_TYPE}"
-        logging.info(f"Scanning image {image} → {report_path}")
-        try:
-            run_trivy(image, report_path)
-        except Exception as e:
-            logging.error(f"Execution failed: {e}")
-            return 1
+    log_summary(results)
+    if any(result.error for result in results):
+        return 1
     logging.info("All scans completed.")
 
 
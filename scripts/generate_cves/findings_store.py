@@ -0,0 +1,222 @@
+#!/usr/bin/env python3
+"""Persistent store of the findings of Trivy scans.
+
+Every scan is recorded with the digest of the image, the date of the scan
+and the release track it was produced for, i.e. `1.10/stable`, along with
+its vulnerabilities. The vulnerability report is built from the findings of
+the scans of a run, and the history of a track can be queried without
+parsing any report again.
+"""
+
+import argparse
+import datetime
+import logging
+import sqlite3
+import sys
+import typing
+from pathlib import Path
+
+import pandas as pd
+
+logger = logging.getLogger(__name__)
+
+FINDINGS_STORE_FILE = "findings.sqlite"
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS scans (
+    id INTEGER PRIMARY KEY,
+    image TEXT NOT NULL,
+    digest TEXT,
+    track TEXT NOT NULL,
+    scan_date TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS findings (
+    scan_id INTEGER NOT NULL REFERENCES scans (id) ON DELETE CASCADE,
+    position INTEGER NOT NULL,
+    vulnerability_id TEXT,
+    package TEXT,
+    version TEXT,
+    severity TEXT,
+    -- Untyped, scores are either numbers or N/A
+    score,
+    fixed_version TEXT,
+    title TEXT,
+    description TEXT
+);
+CREATE INDEX IF NOT EXISTS scans_track_date ON scans (track, scan_date);
+CREATE INDEX IF NOT EXISTS findings_scan ON findings (scan_id, position);
+CREATE INDEX IF NOT EXISTS findings_vulnerability ON findings (vulnerability_id);
+"""
+
+# Columns of the findings, as flattened by produce_vulnerability_report.py
+FINDING_COLUMNS = {
+    "vulnerability_id": "CVE",
+    "package": "Package Name",
+    "version": "Version",
+    "severity": "Severity",
+    "score": "NVD/CVSS Score",
+    "fixed_version": "FixedVersion",
+    "title": "Vulnerability Name",
+    "description": "Description",
+}
+
+
+def get_report_digest(report: dict) -> str | None:
+    """Return the digest of the image a Trivy report was produced for."""
+    metadata = report.get("Metadata") or {}
+    for repo_digest in metadata.get("RepoDigests") or []:
+        return repo_digest.split("@")[-1]
+    return metadata.get("ImageID")
+
+
+def get_report_date(report: dict) -> str:
+    """Return the date a Trivy report was produced, today if unknown."""
+    created_at = report.get("CreatedAt")
+    if created_at:
+        return created_at[:10]
+    return datetime.date.today().isoformat()
+
+
+class FindingsStore:
+    """SQLite store of the findings of Trivy scans.
+
+    Scans are keyed by image, digest, release track and scan date: storing a
+    scan again on the same day replaces its findings.
+    """
+
+    def __init__(self, path: Path):
+        self.path = path
+        self._connection = sqlite3.connect(path)
+        self._connection.execute("PRAGMA foreign_keys = ON")
+        self._connection.executescript(SCHEMA)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self) -> None:
+        self._connection.close()
+
+    def append(
+        self,
+        image: str,
+        report: dict,
+        track: str,
+        findings: dict[str, list],
+    ) -> int:
+        """Store the findings of the scan of an image.
+
+        Args:
+            image: Name of the scanned image
+            report: Trivy report of the image, for its digest and date
+            track: Release track the image was scanned for
+            findings: Vulnerabilities of the report, as flattened into columns
+                      by produce_vulnerability_report.py
+
+        Returns:
+            The ID of the scan in the store
+        """
+        digest = get_report_digest(report)
+        scan_date = get_report_date(report)
+        with self._connection:
+            self._connection.execute(
+                "DELETE FROM scans"
+                " WHERE image = ? AND digest IS ? AND track = ? AND scan_date = ?",
+                (image, digest, track, scan_date),
+            )
+            scan_id = self._connection.execute(
+                "INSERT INTO scans (image, digest, track, scan_date) VALUES (?, ?, ?, ?)",
+                (image, digest, track, scan_date),
+            ).lastrowid
+            self._connection.executemany(
+                f"INSERT INTO findings (scan_id, position, {', '.join(FINDING_COLUMNS)})"
+                f" VALUES (?, ?{', ?' * len(FINDING_COLUMNS)})",
+                (
+                    (scan_id, position, *values)
+                    for position, values in enumerate(
+                        zip(*(findings[column] for column in FINDING_COLUMNS.values()))
+                    )
+                ),
+            )
+        return scan_id
+
+    def get_findings(self, scan_ids: typing.Iterable[int]) -> pd.DataFrame:
+        """Return the findings of scans, in the order they were stored.
+
+        The columns are those of the flattened vulnerabilities, so that the
+        vulnerability report can be built from them.
+        """
+        scan_ids = list(scan_ids)
+        query = (
+            "SELECT scans.image, "
+            + ", ".join(f"findings.{column}" for column in FINDING_COLUMNS)
+            + " FROM findings JOIN scans ON scans.id = findings.scan_id"
+            + f" WHERE scans.id IN ({', '.join('?' * len(scan_ids))})"
+            + " ORDER BY scans.id, findings.position"
+        )
+        rows = self._connection.execute(query, scan_ids).fetchall()
+        findings = pd.DataFrame(
+            rows, columns=["Affected Component", *FINDING_COLUMNS.values()], dtype=object
+        )
+        findings.insert(0, "VulnerabilityID", findings["CVE"].fillna("N/A"))
+        return findings
+
+    def get_new_cves(self, track: str, since: str) -> pd.DataFrame:
+        """Return the CVEs first found in a track on or after a date.
+
+        Args:
+            track: Release track, i.e. `1.10/stable`
+            since: ISO date, i.e. `2024-05-01`
+
+        Returns:
+            DataFrame of the CVEs, with the date they were first found and
+            the images they were found in since then
+        """
+        query = """
+            SELECT findings.vulnerability_id AS CVE,
+                   MIN(scans.scan_date) AS "First Seen",
+                   GROUP_CONCAT(DISTINCT scans.image) AS "Affected Components"
+            FROM findings JOIN scans ON scans.id = findings.scan_id
+            WHERE scans.track = ? AND findings.vulnerability_id IS NOT NULL
+            GROUP BY findings.vulnerability_id
+            HAVING MIN(scans.scan_date) >= ?
+            ORDER BY "First Seen", CVE
+        """
+        return pd.read_sql_query(query, self._connection, params=(track, since))
+
+
+if __name__ == "__main__":
+    logging.basicConfig(stream=sys.stdout, level=logging.INFO)
+
+    parser = argparse.ArgumentParser(
+        description="Query the findings store of produce_vulnerability_report.py"
+    )
+    parser.add_argument(
+        "--store",
+        type=Path,
+        default=FINDINGS_STORE_FILE,
+        help=f"Path to the findings store. Defaults to {FINDINGS_STORE_FILE}.",
+    )
+    parser.add_argument(
+        "--track",
+        required=True,
+        help="Release track to query, i.e. 1.10/stable.",
+    )
+    parser.add_argument(
+        "--since",
+        default=(datetime.date.today() - datetime.timedelta(days=7)).isoformat(),
+        help="List the CVEs first found on or after this date. Defaults to a week ago.",
+    )
+    args = parser.parse_args()
+
+    if not args.store.is_file():
+        raise FileNotFoundError(f"Findings store {args.store} does not exist")
+
+    with FindingsStore(args.store) as store:
+        new_cves = store.get_new_cves(args.track, args.since)
+
+    logger.info(f"{len(new_cves)} new CVEs in {args.track} since {args.since}")
+    if not new_cves.empty:
+        print(new_cves.to_string(index=False))
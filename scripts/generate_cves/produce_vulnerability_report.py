@@ -1,23 +1,90 @@
 import argparse
+import collections
+import contextlib
 import csv
 import json
 import logging
-import subprocess
 import sys
 import typing
-import tenacity
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 
+import numpy as np
 import pandas as pd
 import os
 from pathlib import Path
 from enum import Enum
 
+from create_trivy_reports import (
+    CACHE_INDEX_FILE,
+    CACHE_TTL_HOURS,
+    ReportCache,
+    get_trivy_db_version,
+    scan_image_group,
+)
+from findings_store import FINDINGS_STORE_FILE, FindingsStore
+from utils import (
+    ensure_positive_int,
+    get_report_path,
+    group_images_by_digest,
+    load_with_sidecar,
+    trivy_server,
+    write_atomic,
+)
+
+try:
+    # Faster JSON parser, used for the reports when installed
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    # Streaming Excel writer, used for the report when installed
+    import xlsxwriter
+except ImportError:
+    xlsxwriter = None
+
+try:
+    # Parquet engine, required for the .parquet reports only
+    import pyarrow
+except ImportError:
+    pyarrow = None
+
 LOG_FORMAT = "%(levelname)s:%(name)s: %(message)s"
 logging.basicConfig(level=logging.INFO, stream=sys.stdout, format=LOG_FORMAT)
 logger = logging.getLogger(__name__)
 
 EXCEPTION_FILE = "CVE_Exceptions.xlsx"
 REPORT_CSV_FILE = "Vulnerability_Tracker-Charmed_Kubeflow.xlsx"
+DELTA_REPORT_FILE = "Vulnerability_Delta-Charmed_Kubeflow.xlsx"
+UPSTREAM_INDEX_FILE = "upstream_cves_index.json"
+# Not trivy-reports, the directory of create_trivy_reports.py, so that the
+# scans of image lists never end up in the directories of reports read back
+REPORT_DIR = "scanned-reports"
+UPSTREAM_REPORT_DIR = "scanned-upstream-reports"
+REPORT_FORMATS = [".xlsx", ".csv", ".parquet"]
+ALL_SHEET = "All Vulnerabilities"
+PRIORITY_SHEET = "Critical, High, KEVs"
+DELTA_SHEET = "Delta"
+# Fields of a (CVE, image) pair whose change is reported by the delta
+DELTA_FIELDS = [
+    "Is KEV?",
+    "Severity",
+    "NVD/CVSS Score",
+    "Relevant to Product?",
+    "Patchable",
+    "Ticket",
+]
+
+# Fields of the vulnerabilities read when producing the report
+VULNERABILITY_FIELDS = [
+    "VulnerabilityID",
+    "PkgName",
+    "InstalledVersion",
+    "Severity",
+    "FixedVersion",
+    "Title",
+    "Description",
+]
 
 
 class ImageInputType(str, Enum):
@@ -25,51 +92,160 @@ class ImageInputType(str, Enum):
     FOLDER_REPORTS = "folder_reports"
 
 
-@tenacity.retry(
-    stop=tenacity.stop_after_attempt(3), wait=tenacity.wait_fixed(3), reraise=True
-)
-def run_trivy_scan(image_name: str) -> dict:
-    logger.info(f"Scanning: {image_name}")
-    process = subprocess.run(
-        [
-            "trivy",
-            "image",
-            image_name,
-            "-q",
-            "--format",
-            "json",
-            "--timeout",
-            "10m",
-            "--skip-files",
-            "'/bin/pebble,/usr/bin/pebble,usr/bin/pebble,bin/pebble'",
-        ],
-        capture_output=True,
-        text=True,
+class ExceptionIndex(typing.NamedTuple):
+    # Rationale of the exceptions, structured as { <CVE>: { <IMAGE>: <RATIONALE> } }
+    rationales: dict[str, dict[str, str]]
+    # Most common rationale of each CVE, for images without an exception
+    most_common: dict[str, str]
+
+
+def copy_shared_report(
+    digest: str, image_names: list[str], cache: ReportCache, shared: list[ReportCache]
+) -> None:
+    # Copy a fresh report of the same image from the report directory of the
+    # other list, so that images in both lists are only scanned once
+    report_path = get_report_path(image_names[0], cache.index_path.parent)
+    if not digest.startswith("sha256:") or cache.is_fresh(
+        image_names[0], digest, report_path
+    ):
+        return
+    for shared_cache in shared:
+        for image_name in image_names:
+            shared_path = get_report_path(image_name, shared_cache.index_path.parent)
+            if shared_cache.is_fresh(image_name, digest, shared_path):
+                report = json.loads(shared_path.read_text())
+                report["ArtifactName"] = image_names[0]
+                write_atomic(report_path, json.dumps(report, indent=2))
+                cache.record(image_names[0], digest, report_path)
+                logger.info(f"Report of {image_name} reused from {shared_path}")
+                return
+
+
+def scan_or_resume(
+    digest: str,
+    image_names: list[str],
+    server: str | None,
+    cache: ReportCache,
+    shared: list[ReportCache],
+) -> dict:
+    # Reuse the report of the image if the cache of the report directory
+    # still considers it fresh, i.e. written by an interrupted run, or else
+    # scan the image and record its report before using it
+    copy_shared_report(digest, image_names, cache, shared)
+    result = scan_image_group(
+        digest, image_names, cache.index_path.parent, cache, server
     )
-    if process.returncode != 0:
-        logger.error(f"Failed to scan {image_name}. Error: {process.stderr}")
-        raise Exception(f"Trivy scan failed: {process.stderr}")
-    else:
-        try:
-            return json.loads(process.stdout)
-        except json.JSONDecodeError as e:
-            logger.error("Failed to decode JSON output for {image_name}.")
-            raise e
+    if result.error:
+        raise RuntimeError(f"Trivy scan failed for {result.image}: {result.error}")
+    return project_report(get_output(result.report_path))
+
+
+def iter_images(
+    image_path: str,
+    server: str | None = None,
+    parallel: int = 1,
+    report_dir: Path = Path(REPORT_DIR),
+    db_version: str | None = None,
+    shared_dirs: list[Path] | None = None,
+):
+    """Iterate over the reports of the images of a list, scanning them in a pipeline.
+
+    Args:
+        image_path: File listing the images, one per line
+        server: URL of the Trivy server to scan the images with, if any
+        parallel: Number of images to scan concurrently
+        report_dir: Directory the reports are written to as they are
+                    produced, and resumed from
+        db_version: Version of the Trivy DB the images are scanned with.
+                    Reports are only resumed from if they were produced with
+                    it, as tracked by the cache index of create_trivy_reports.py.
+        shared_dirs: Report directories of other lists, whose fresh reports
+                     are copied instead of scanning the same images again
+
+    Returns:
+        Iterator of (image name, report) pairs, in the order of the list
+    """
+    with open(image_path, "r") as file:
+        lines = [line.strip() for line in file if line.strip()]
+    report_dir.mkdir(parents=True, exist_ok=True)
+    cache = ReportCache(report_dir / CACHE_INDEX_FILE, db_version, CACHE_TTL_HOURS)
+    # Read when the iteration starts, i.e. once the upstream list is scanned
+    shared = [
+        ReportCache(shared_dir / CACHE_INDEX_FILE, db_version, CACHE_TTL_HOURS)
+        for shared_dir in shared_dirs or []
+    ]
+
+    # References to the same image are only scanned once, and share the report
+    groups = group_images_by_digest(lines, parallel).items()
+
+    # The workers scan ahead while the reports are consumed in the order of
+    # the list, with at most `backlog` of them waiting to be consumed
+    backlog = 2 * parallel
+    pending = collections.deque()
+
+    def drain(limit: int):
+        while len(pending) > limit:
+            image_names, future = pending.popleft()
+            json_data = future.result()
+            for image_name in image_names:
+                yield image_name, json_data
+
+    executor = ThreadPoolExecutor(max_workers=parallel)
+    try:
+        for digest, image_names in groups:
+            pending.append(
+                (
+                    image_names,
+                    executor.submit(
+                        scan_or_resume, digest, image_names, server, cache, shared
+                    ),
+                )
+            )
+            yield from drain(backlog)
+        yield from drain(0)
+    finally:
+        executor.shutdown(cancel_futures=True)
 
 
-def iter_images(image_path: str):
-    with open(image_path, "r") as file:
-        lines = [line.strip() for line in file]
+def get_output(filename: Path) -> dict:
+    with open(filename, "rb") as fid:
+        if orjson:
+            return orjson.loads(fid.read())
+        return json.load(fid)
 
-        for image_name in lines:
-            json_data = run_trivy_scan(image_name)
 
-            yield image_name, json_data
+def project_report(data: dict) -> dict:
+    # Keep only the fields of the report read by scan_images,
+    # get_upstream_cves and the findings store, so that the full documents are not kept in memory
+    results = []
+    for result in data.get("Results") or []:
+        vulnerabilities = []
+        for vulnerability in result.get("Vulnerabilities") or []:
+            projected = {
+                field: vulnerability[field]
+                for field in VULNERABILITY_FIELDS
+                if field in vulnerability
+            }
+            nvd = (vulnerability.get("CVSS") or {}).get("nvd") or {}
+            if "V3Score" in nvd:
+                projected["CVSS"] = {"nvd": {"V3Score": nvd["V3Score"]}}
+            vulnerabilities.append(projected)
+        results.append({"Vulnerabilities": vulnerabilities})
+    metadata = data.get("Metadata") or {}
+    return {
+        "ArtifactName": data["ArtifactName"],
+        "CreatedAt": data.get("CreatedAt"),
+        "Metadata": {
+            "RepoDigests": metadata.get("RepoDigests"),
+            "ImageID": metadata.get("ImageID"),
+        },
+        "Results": results,
+    }
 
 
-def get_output(filename: Path) -> dict:
-    with open(filename, "r") as fid:
-        return json.load(fid)
+def load_report(filename: Path) -> tuple[str, dict]:
+    report = project_report(get_output(filename))
+    return report["ArtifactName"], report
 
 
 def get_json_files(root_path: str) -> typing.Iterator[tuple[Path, Path]]:
@@ -80,20 +256,34 @@ def get_json_files(root_path: str) -> typing.Iterator[tuple[Path, Path]]:
                 yield Path(root).relative_to(root_path), p
 
 
-def iter_reports(image_path: str):
-    for folder, filename in get_json_files(image_path):
-        output = get_output(Path(image_path) / folder / filename)
-        yield output["ArtifactName"], output
+def iter_reports(image_path: str, jobs: int | None = None):
+    """Iterate over the reports of a directory, parsed in a pool of processes.
 
+    Args:
+        image_path: Directory of Trivy JSON reports
+        jobs: Number of processes parsing the reports, defaults to the
+              number of CPUs. With a single job, the reports are parsed in
+              the current process.
 
-def get_exceptions(exception_file: Path) -> dict:
-    # Get the dictionary of exceptions that is structured with the following
-    # structure:
-    # { <CVE>: { <IMAGE>: <RATIONALE> } }
+    Returns:
+        Iterator of (image name, report) pairs, in the order of the files
+    """
+    filenames = [
+        Path(image_path) / folder / filename
+        for folder, filename in get_json_files(image_path)
+    ]
 
-    if not exception_file.exists():
-        return {}
+    if jobs == 1 or len(filenames) <= 1:
+        yield from map(load_report, filenames)
+        return
+
+    with ProcessPoolExecutor(max_workers=jobs) as executor:
+        yield from executor.map(load_report, filenames)
 
+
+def parse_exceptions(
+    exception_file: Path,
+) -> tuple[dict[str, dict[str, str]], dict[str, str]]:
     # The files has the following columns: Package, Version, CVE, CVSS Score, Image Name, Patchable, ETA, Rationale
     # However the first four columns represents a MultiIndex, and need to be provided as index_col below to ensure
     # the correct parsing
@@ -102,17 +292,40 @@ def get_exceptions(exception_file: Path) -> dict:
     selection = df[df["Patchable"] == "No"][
         ["CVE", "Image Name", "Rationale"]
     ].drop_duplicates()
+    selection = selection[selection["CVE"].notna()]
+
+    images = selection["Image Name"].str.removeprefix("docker-quarantine-local/")
+
+    rationales = {}
+    for cve, image, rationale in zip(selection["CVE"], images, selection["Rationale"]):
+        rationales.setdefault(cve, {})[image] = rationale
+    rationales = dict(sorted(rationales.items()))
+
+    most_common = {
+        cve: pd.Series(exception)
+        .value_counts()
+        .sort_values(ascending=False)
+        .head(1)
+        .index[0]
+        for cve, exception in rationales.items()
+        if exception
+    }
 
-    selection["Image Name"] = selection["Image Name"].apply(
-        lambda x: x.removeprefix("docker-quarantine-local/")
-    )
+    return rationales, most_common
 
-    return {
-        name: group[["Image Name", "Rationale"]]
-        .set_index("Image Name")["Rationale"]
-        .to_dict()
-        for name, group in selection.groupby("CVE")
-    }
+
+def get_exceptions(exception_file: Path) -> ExceptionIndex:
+    # Get the index of exceptions, with the rationale of each exception
+    # structured as:
+    # { <CVE>: { <IMAGE>: <RATIONALE> } }
+    # and the most common rationale of each CVE, computed once here rather
+    # than for every vulnerability of an image without an exception.
+    # Parsing the file is slow, so the index is cached next to it
+
+    if not exception_file.exists():
+        return ExceptionIndex({}, {})
+
+    return ExceptionIndex(*load_with_sidecar(exception_file, parse_exceptions))
 
 
 def get_kves(kev_file_path: Path) -> set[str]:
@@ -134,172 +347,461 @@ def get_kves(kev_file_path: Path) -> set[str]:
 
 def get_upstream_cves(
     iter_scans: typing.Iterator[tuple[str, dict]],
-) -> dict[str, list[str]]:
+) -> set[str]:
+    # Only the presence of a CVE upstream is reported, not the images
+    return {
+        vulnerability.get("VulnerabilityID", "N/A")
+        for _, data in iter_scans
+        for result in data.get("Results", [])
+        for vulnerability in result.get("Vulnerabilities", [])
+    }
+
 
-    vulns = {}
+def load_upstream_cves(
+    upstream_path: str | None,
+    release: str | None,
+    index_path: Path,
+    iter_scans: typing.Callable[[Path], typing.Iterator[tuple[str, dict]]],
+) -> set[str] | None:
+    """Get the CVEs of the upstream images, from the index when possible.
+
+    Args:
+        upstream_path: Directory of Trivy JSON reports, or list of the
+                       upstream images
+        release: Upstream release the reports belong to. Its CVEs are saved
+                 to the index once parsed, and read from there when no
+                 upstream path is given.
+        index_path: JSON file indexing the CVEs of each upstream release
+        iter_scans: Function iterating over the reports of the upstream path
+
+    Returns:
+        The set of upstream CVEs, or None without upstream reports
+    """
+    index = json.loads(index_path.read_text()) if index_path.is_file() else {}
+    if not upstream_path:
+        if release in index:
+            logger.info(f"Using the upstream CVEs of {release} from {index_path}")
+            return set(index[release])
+        if release:
+            raise FileNotFoundError(
+                f"Upstream release {release} is not in {index_path}, "
+                "its reports must be provided with --upstream-path"
+            )
+        return None
+
+    cves = get_upstream_cves(iter_scans(Path(upstream_path)))
+    if release:
+        if release in index:
+            logger.info(f"Replacing the upstream CVEs of {release} in {index_path}")
+        index[release] = sorted(cves)
+        write_atomic(index_path, json.dumps(index, indent=2, sort_keys=True))
+        logger.info(f"Saved the upstream CVEs of {release} to {index_path}")
+    return cves
+
+
+def flatten_vulnerabilities(
+    iter_scans: typing.Iterator[tuple[str, dict]],
+) -> dict[str, list]:
+    # Flatten the vulnerabilities of the reports into columns as they stream
+    # in, so that only the fields used by the report are kept in memory
+    columns = {
+        "VulnerabilityID": [],
+        "CVE": [],
+        "Package Name": [],
+        "Version": [],
+        "Severity": [],
+        "NVD/CVSS Score": [],
+        "FixedVersion": [],
+        "Vulnerability Name": [],
+        "Description": [],
+        "Affected Component": [],
+    }
 
     for image_name, data in iter_scans:
         for result in data.get("Results", []):
             for vulnerability in result.get("Vulnerabilities", []):
-                vuln_id = vulnerability.get("VulnerabilityID", "N/A")
-                if vuln_id in vulns:
-                    vulns[vuln_id].append(image_name)
-                else:
-                    vulns[vuln_id] = [image_name]
-    return vulns
+                columns["VulnerabilityID"].append(
+                    vulnerability.get("VulnerabilityID", "N/A")
+                )
+                columns["CVE"].append(vulnerability.get("VulnerabilityID"))
+                columns["Package Name"].append(vulnerability.get("PkgName", "N/A"))
+                columns["Version"].append(vulnerability.get("InstalledVersion", "N/A"))
+                columns["Severity"].append(vulnerability.get("Severity", "N/A"))
+                columns["NVD/CVSS Score"].append(
+                    vulnerability.get("CVSS", {}).get("nvd", {}).get("V3Score", "N/A")
+                )
+                columns["FixedVersion"].append(vulnerability.get("FixedVersion"))
+                columns["Vulnerability Name"].append(vulnerability.get("Title", "N/A"))
+                columns["Description"].append(vulnerability.get("Description", "N/A"))
+                columns["Affected Component"].append(image_name)
+
+    return columns
+
+
+def lookup_cve_images(
+    table: dict[str, dict[str, str]], cves: pd.Series, image_refs: pd.Series
+) -> tuple[np.ndarray, np.ndarray]:
+    # Look up table[cve][image_ref] for every (cve, image_ref) pair with a
+    # single hash join, and return which pairs were found and their values
+    entries = pd.DataFrame(
+        [
+            (cve, image, value)
+            for cve, images in table.items()
+            for image, value in images.items()
+        ],
+        columns=["CVE", "Image", "Value"],
+        dtype=object,
+    )
+    pairs = pd.DataFrame({"CVE": cves.values, "Image": image_refs.values}, dtype=object)
+    matches = pairs.merge(entries, how="left", on=["CVE", "Image"], indicator=True)
+    return (matches["_merge"] == "both").values, matches["Value"].values
+
+
+def store_scans(
+    iter_scans: typing.Iterator[tuple[str, dict]],
+    store: FindingsStore,
+    track: str,
+) -> list[int]:
+    # Append the findings of every scan to the store, and return the IDs of
+    # the scans to build the report from
+    return [
+        store.append(
+            image_name, data, track, flatten_vulnerabilities([(image_name, data)])
+        )
+        for image_name, data in iter_scans
+    ]
 
 
 def scan_images(
     iter_scans: typing.Iterator[tuple[str, dict]],
     kev_cve_set: set[str],
-    exceptions: dict[str, dict[str, str]],
-    upstream_vulns: dict[str, list[str]] | None,
+    exceptions: ExceptionIndex,
+    upstream_vulns: set[str] | None,
     actions: dict[str, dict[str, str]],
 ) -> pd.DataFrame:
+    return report_findings(
+        pd.DataFrame(flatten_vulnerabilities(iter_scans), dtype=object),
+        kev_cve_set,
+        exceptions,
+        upstream_vulns,
+        actions,
+    )
 
-    vulnerability_count = 0
-    seen_vulnerabilities = set()
 
-    rows = []
+def report_findings(
+    findings: pd.DataFrame,
+    kev_cve_set: set[str],
+    exceptions: ExceptionIndex,
+    upstream_vulns: set[str] | None,
+    actions: dict[str, dict[str, str]],
+) -> pd.DataFrame:
+    # Build the rows of the report from the flattened findings, either read
+    # from the reports or from the findings store
 
-    for image_name, data in iter_scans:
-        for result in data.get("Results", []):
-            for vulnerability in result.get("Vulnerabilities", []):
-                vuln_id = vulnerability.get("VulnerabilityID", "N/A")
-                unique_vulnerability_key = (vuln_id, image_name)
-                image_ref = image_name.split(":")[0]
-
-                if unique_vulnerability_key in seen_vulnerabilities:
-                    continue
-                seen_vulnerabilities.add(unique_vulnerability_key)
-                vulnerability_count += 1
-
-                is_kev = (
-                    "Yes"
-                    if vulnerability.get("VulnerabilityID", "N/A") in kev_cve_set
-                    else "No"
-                )
+    # Only the first occurrence of a vulnerability in an image is reported
+    findings = findings.drop_duplicates(["VulnerabilityID", "Affected Component"])
+    logger.info(f"Found {len(findings)} vulnerabilities")
 
-                patch_exists = (
-                    "FixedVersion" in vulnerability and vulnerability["FixedVersion"]
-                )
-                fixed_version = (
-                    vulnerability["FixedVersion"]
-                    if "FixedVersion" in vulnerability
-                    else "N/A"
-                )
+    findings = findings[findings["CVE"].astype(bool)].reset_index(drop=True)
+    if findings.empty:
+        return pd.DataFrame()
 
-                cveId = vulnerability.get("VulnerabilityID")
-
-                if not cveId:
-                    continue
-
-                exception = exceptions.get(cveId)
-
-                if exception:
-                    if image_ref in exception:
-                        rational = exception[image_ref]
-                    else:
-                        most_common = (
-                            pd.Series(exception)
-                            .value_counts()
-                            .sort_values(ascending=False)
-                            .head(1)
-                            .index[0]
-                        )
-                        rational = f"(Possible) {most_common}"
-
-                    out_dict = {
-                        "Relevant to Product?": "No",
-                        "Reason": rational,
-                    }
-                else:
-                    can_be_remediated = (
-                        "Yes"
-                        if cveId in actions and image_ref in actions[cveId]
-                        else "No"
-                    )
-                    action_plan = (
-                        actions[cveId][image_ref] if can_be_remediated == "Yes" else ""
-                    )
-
-                    out_dict = {
-                        "Relevant to Product?": "Yes",
-                        "Patchable": can_be_remediated,
-                        "Ticket": action_plan,
-                    }
-
-                rows.append(
-                    {
-                        "CVE": cveId,
-                        "Package Name": vulnerability.get("PkgName", "N/A"),
-                        "Version": vulnerability.get("InstalledVersion", "N/A"),
-                        "Is KEV?": is_kev,
-                        "Severity": vulnerability.get("Severity", "N/A").capitalize(),
-                        "NVD/CVSS Score": vulnerability.get("CVSS", {})
-                        .get("nvd", {})
-                        .get("V3Score", "N/A"),
-                        "Upstream presence": (
-                            "Yes" if cveId in upstream_vulns else "No"
-                        )
-                        if upstream_vulns
-                        else "N/A",
-                        "Patch version": fixed_version if patch_exists else "N/A",
-                        "Patch produced by Canonical": (
-                            "Yes" if "ubuntu" in fixed_version else "No"
-                        )
-                        if patch_exists
-                        else "N/A",
-                        "Vulnerability Name": vulnerability.get("Title", "N/A"),
-                        "Description": vulnerability.get("Description", "N/A").replace(
-                            "\r", "\n"
-                        ),
-                        "Affected Component": image_name,
-                    }
-                    | out_dict
-                )
+    cves = findings["CVE"]
+    components = findings["Affected Component"]
+    image_refs = components.map(
+        {image: image.split(":")[0] for image in components.unique()}
+    )
+
+    fixed_version = findings["FixedVersion"]
+    patch_exists = fixed_version.astype(bool)
+    patch_version = fixed_version.where(patch_exists, "N/A")
+
+    rows = pd.DataFrame(
+        {
+            "CVE": cves.values,
+            "Package Name": findings["Package Name"].values,
+            "Version": findings["Version"].values,
+            "Is KEV?": np.where(cves.isin(list(kev_cve_set)), "Yes", "No"),
+            "Severity": findings["Severity"].str.capitalize().values,
+            "NVD/CVSS Score": findings["NVD/CVSS Score"].values,
+            "Upstream presence": (
+                np.where(cves.isin(list(upstream_vulns)), "Yes", "No")
+                if upstream_vulns
+                else "N/A"
+            ),
+            "Patch version": patch_version.values,
+            "Patch produced by Canonical": np.where(
+                patch_exists,
+                np.where(
+                    patch_version.str.contains("ubuntu", regex=False), "Yes", "No"
+                ),
+                "N/A",
+            ),
+            "Vulnerability Name": findings["Vulnerability Name"].values,
+            "Description": findings["Description"]
+            .str.replace("\r", "\n", regex=False)
+            .values,
+            "Affected Component": components.values,
+        }
+    )
+
+    has_exception = cves.isin(list(exceptions.most_common)).values
+
+    # Not relevant vulnerabilities: the rationale of the exception for the
+    # image, or else the most common rationale of the CVE
+    has_rationale, rationale = lookup_cve_images(
+        exceptions.rationales, cves, image_refs
+    )
+    possible = "(Possible) " + cves.map(exceptions.most_common).astype(str)
+    reason = pd.Series(np.where(has_rationale, rationale, possible))
 
-    logger.info(f"Found {vulnerability_count} vulnerabilities")
+    # Relevant vulnerabilities: the ticket remediating it in the image, if any
+    has_ticket, ticket = lookup_cve_images(actions, cves, image_refs)
+
+    relevance = {
+        "Relevant to Product?": pd.Series(np.where(has_exception, "No", "Yes")),
+    }
+    if has_exception.any():
+        relevance["Reason"] = reason.where(has_exception)
+    if not has_exception.all():
+        relevance["Patchable"] = pd.Series(np.where(has_ticket, "Yes", "No")).where(
+            ~has_exception
+        )
+        relevance["Ticket"] = pd.Series(np.where(has_ticket, ticket, "")).where(
+            ~has_exception
+        )
+
+    # Keep the columns in the order they would first appear row by row
+    order = ["Relevant to Product?", "Patchable", "Ticket", "Reason"]
+    if has_exception[0]:
+        order = ["Relevant to Product?", "Reason", "Patchable", "Ticket"]
+    for column in order:
+        if column in relevance:
+            rows[column] = relevance[column]
+
+    return rows.infer_objects()
+
+
+def parse_tickets(filename: Path) -> dict[str, dict[str, str]]:
+    actions_df = pd.read_excel(filename, index_col=[0, 1])
+    tickets = (
+        actions_df.reset_index().set_index(["CVE", "Image"])[["Ticket"]].sort_index()
+    ).reset_index()
+    tickets = tickets[tickets["CVE"].notna()]
 
-    return pd.DataFrame.from_records(rows)
+    # Output as nested dictionary
+    actions = {}
+    for cve, image, ticket in zip(tickets["CVE"], tickets["Image"], tickets["Ticket"]):
+        actions.setdefault(cve, {})[image] = ticket
+    return actions
 
 
 def read_tickets(filename: str) -> dict:
+    # Parsing the file is slow, so the tickets are cached next to it
     try:
-        actions_df = pd.read_excel(filename, index_col=[0, 1])
+        return load_with_sidecar(Path(filename), parse_tickets)
     except FileNotFoundError:
         return {}
-    tickets = (
-        actions_df.reset_index().set_index(["CVE", "Image"])[["Ticket"]].sort_index()
+
+
+# We also want to merge CVEs, so only one entry exists for each CVE
+def merge_cve(input_df: pd.DataFrame) -> pd.DataFrame:
+    """Merge CVEs with same ID on different images"""
+
+    # Each CVE keeps the fields of its first row, with the affected components
+    # of all of its rows joined, and the distinct tickets among them joined
+    merged = input_df.drop_duplicates("CVE").set_index("CVE").sort_index()
+    merged["Affected Component"] = input_df.groupby("CVE")["Affected Component"].agg(
+        ",".join
     )
 
-    # Output as nested dictionary
-    return (
-        tickets.groupby(level=0)
-        .apply(lambda df: df.xs(df.name)["Ticket"].to_dict())
-        .to_dict()
+    if "Ticket" in merged:
+        tickets = input_df[["CVE", "Ticket"]].drop_duplicates()
+        tickets = tickets[tickets["Ticket"].str.len() > 0]
+        merged["Ticket"] = (
+            tickets.groupby("CVE")["Ticket"]
+            .agg(",".join)
+            .reindex(merged.index, fill_value="")
+        )
+
+    return merged
+
+
+def get_priority_mask(merged_list: pd.DataFrame) -> pd.Series:
+    # CVEs which are "High", "Critical", or are part of KEVs
+    return merged_list["Severity"].isin(["Critical", "High"]) | (
+        merged_list["Is KEV?"] == "Yes"
     )
 
 
-# We also want to merge CVEs, so only one entry exists for each CVE
-def merge_cve(input_df: pd.DataFrame):
-    """Merge CVEs with same ID on different images"""
+def write_excel_sheet(workbook, sheet_name: str, df: pd.DataFrame) -> None:
+    # Write the rows one after the other, as the worksheets of a workbook in
+    # constant memory mode only keep the current row
+    worksheet = workbook.add_worksheet(sheet_name)
+    header = workbook.add_format({"bold": True, "border": 1, "align": "center"})
+    worksheet.write_row(0, 0, [df.index.name, *df.columns], header)
+    for row_index, row in enumerate(df.itertuples(), start=1):
+        worksheet.write_row(
+            row_index, 0, [None if pd.isna(value) else value for value in row]
+        )
 
-    def reduce(subset: pd.DataFrame):
-        components = ",".join(subset["Affected Component"].values)
-        tickets = ",".join(
-            {
-                ticket
-                for ticket in subset["Ticket"].values
-                if ticket and isinstance(ticket, str)
-            }
+
+def write_excel_report(path: Path, sheets: dict[str, pd.DataFrame]) -> None:
+    if xlsxwriter is None:
+        with pd.ExcelWriter(path) as writer:
+            for sheet_name, df in sheets.items():
+                df.to_excel(writer, sheet_name=sheet_name)
+        return
+
+    options = {"constant_memory": True, "strings_to_urls": False}
+    with xlsxwriter.Workbook(path, options) as workbook:
+        for sheet_name, df in sheets.items():
+            write_excel_sheet(workbook, sheet_name, df)
+
+
+def write_table(path: Path, table: pd.DataFrame) -> None:
+    if path.suffix == ".csv":
+        table.to_csv(path)
+    elif path.suffix == ".parquet":
+        # Columns mixing numbers and text, i.e. scores and N/A, are stored
+        # as text
+        mixed = [column for column, dtype in table.dtypes.items() if dtype == object]
+        table.astype({column: "string" for column in mixed}).to_parquet(path)
+
+
+def write_report(merged_list: pd.DataFrame, outputs: list[Path]) -> None:
+    """Write the report to every output, in the format of its extension.
+
+    Excel reports have a sheet with all the vulnerabilities, and one with the
+    Critical, High and KEV ones only. CSV and Parquet reports have a single
+    table, with a column flagging the Critical, High and KEV vulnerabilities.
+    """
+    priority = get_priority_mask(merged_list)
+
+    for output in outputs:
+        logger.info(f"Writing the report to {output}")
+        if output.suffix == ".xlsx":
+            write_excel_report(
+                output,
+                {
+                    ALL_SHEET: merged_list,
+                    PRIORITY_SHEET: merged_list[priority],
+                },
+            )
+        else:
+            write_table(output, merged_list.assign(**{PRIORITY_SHEET: priority}))
+
+
+def read_report(path: Path) -> pd.DataFrame:
+    # Read all the vulnerabilities of a report written by write_report, as text
+    if path.suffix == ".xlsx":
+        return pd.read_excel(
+            path, sheet_name=ALL_SHEET, index_col=0, dtype=str, keep_default_na=False
+        )
+    if path.suffix == ".csv":
+        return pd.read_csv(path, index_col=0, dtype=str, keep_default_na=False)
+    return pd.read_parquet(path)
+
+
+def get_report_pairs(merged_list: pd.DataFrame) -> pd.DataFrame:
+    # Split the merged report into one row per (CVE, image) pair, with its
+    # fields as text so that reports read back from any format compare equal
+    pairs = merged_list.reset_index()
+    pairs["Affected Component"] = pairs["Affected Component"].str.split(",")
+    pairs = pairs.explode("Affected Component", ignore_index=True)
+
+    scores = pd.to_numeric(pairs["NVD/CVSS Score"], errors="coerce")
+    pairs["NVD/CVSS Score"] = pairs["NVD/CVSS Score"].where(
+        scores.isna(), scores.map("{:g}".format)
+    )
+    return pairs.fillna("").astype(str)
+
+
+def get_delta(merged_list: pd.DataFrame, baseline: pd.DataFrame) -> pd.DataFrame:
+    """Compare a report with a baseline report, by (CVE, image) pair.
+
+    Args:
+        merged_list: Merged vulnerabilities of the current report
+        baseline: Merged vulnerabilities of the baseline report
+
+    Returns:
+        The pairs which are new in the report, resolved since the baseline,
+        or whose DELTA_FIELDS changed, i.e. their severity or ticket.
+        Resolved pairs have the fields of the baseline.
+    """
+    keys = ["CVE", "Affected Component"]
+    current = get_report_pairs(merged_list)
+    previous = get_report_pairs(baseline)
+    fields = [
+        column
+        for column in current.columns
+        if column in previous.columns and column not in keys
+    ]
+    compared = [field for field in DELTA_FIELDS if field in fields]
+
+    joined = current[keys + fields].merge(
+        previous[keys + fields],
+        how="outer",
+        on=keys,
+        suffixes=("", " (Baseline)"),
+        indicator=True,
+    )
+    baseline_fields = [f"{field} (Baseline)" for field in fields]
+    compared_baseline = [f"{field} (Baseline)" for field in compared]
+    differs = joined[compared].values != joined[compared_baseline].values
+    change = np.select(
+        [
+            joined["_merge"] == "left_only",
+            joined["_merge"] == "right_only",
+            differs.any(axis=1),
+        ],
+        ["New", "Resolved", "Changed"],
+        default="",
+    )
+
+    # Only the pairs of the delta are processed from here on
+    in_delta = change != ""
+    change, differs = change[in_delta], differs[in_delta]
+    joined = joined[in_delta]
+    values = joined[fields].values
+    baseline_values = joined[baseline_fields].values
+
+    changes = [
+        (
+            ", ".join(
+                f"{field}: {old} -> {new}"
+                for field, old, new, differ in zip(compared, olds, news, differ_row)
+                if differ
+            )
+            if row_change == "Changed"
+            else ""
+        )
+        for row_change, olds, news, differ_row in zip(
+            change, joined[compared_baseline].values, joined[compared].values, differs
         )
-        row = subset.iloc[0].copy(deep=True)
-        row["Affected Component"] = components
-        row["Ticket"] = tickets
-        return row
+    ]
 
-    return input_df.groupby("CVE").apply(reduce, include_groups=False)
+    resolved = (change == "Resolved")[:, np.newaxis]
+    delta = pd.DataFrame(np.where(resolved, baseline_values, values), columns=fields)
+    delta.insert(0, "Changes", changes)
+    delta.insert(0, "Affected Component", joined["Affected Component"].values)
+    delta.insert(0, "Change", change)
+    delta.insert(0, "CVE", joined["CVE"].values)
+
+    order = {"New": 0, "Changed": 1, "Resolved": 2}
+    delta["Order"] = delta["Change"].map(order)
+    delta = delta.sort_values(["Order"] + keys, kind="stable")
+    return delta.drop(columns="Order").set_index("CVE")
+
+
+def write_delta(delta: pd.DataFrame, outputs: list[Path]) -> None:
+    # Write the delta alone to every output, in the format of its extension
+    for output in outputs:
+        logger.info(f"Writing the delta report to {output}")
+        if output.suffix == ".xlsx":
+            write_excel_report(output, {DELTA_SHEET: delta})
+        else:
+            write_table(output, delta)
 
 
 if __name__ == "__main__":
@@ -321,7 +823,21 @@ if __name__ == "__main__":
         dest="UPSTREAM",
         type=str,
         default=None,
-        help="Path to a directory of Trivy JSON reports representing upstream images.",
+        help="Path to a directory of Trivy JSON reports, or to a list of images, representing upstream images.",
+    )
+    parser.add_argument(
+        "--upstream-release",
+        dest="UPSTREAM_RELEASE",
+        type=str,
+        default=None,
+        help="Upstream Kubeflow release of the upstream reports, i.e. 1.10. Its CVEs are saved to the upstream index, replacing any previous entry, and read from there by later runs given no --upstream-path.",
+    )
+    parser.add_argument(
+        "--upstream-index",
+        dest="UPSTREAM_INDEX",
+        type=str,
+        default=UPSTREAM_INDEX_FILE,
+        help="Path to the file indexing the CVEs of each upstream release.",
     )
     parser.add_argument(
         "--tickets",
@@ -346,8 +862,115 @@ if __name__ == "__main__":
         default="known_exploited_vulnerabilities.csv",
         help="Path to the CSV file containing Known Exploited Vulnerabilities (KEVs).",
     )
+    parser.add_argument(
+        "-j",
+        "--jobs",
+        dest="JOBS",
+        type=ensure_positive_int,
+        default=None,
+        help="Number of processes to parse the JSON reports with. Defaults to the number of CPUs.",
+    )
+    parser.add_argument(
+        "--baseline",
+        dest="BASELINE",
+        type=Path,
+        default=None,
+        help="Path to a previous report, as written by this script. Only the (CVE, image) pairs which are new, resolved or changed since then are written, to a single delta sheet.",
+    )
+    parser.add_argument(
+        "--store",
+        dest="STORE",
+        nargs="?",
+        const=FINDINGS_STORE_FILE,
+        default=None,
+        help=f"Append the findings to a findings store, and produce the report from it. Defaults to {FINDINGS_STORE_FILE} when no path is given.",
+    )
+    parser.add_argument(
+        "--track",
+        dest="TRACK",
+        type=str,
+        default=None,
+        help="Release track the images are scanned for, i.e. 1.10/stable. Required with --store.",
+    )
+    parser.add_argument(
+        "-o",
+        "--output",
+        dest="OUTPUT",
+        action="append",
+        type=Path,
+        help=f"Path to write the report to, either a .xlsx, .csv or .parquet file. Can be provided multiple times. Defaults to {REPORT_CSV_FILE}, or {DELTA_REPORT_FILE} with --baseline.",
+    )
+    parser.add_argument(
+        "-p",
+        "--parallel",
+        dest="PARALLEL",
+        type=ensure_positive_int,
+        default=1,
+        help="Number of images to scan concurrently, when INPUT_PATH or --upstream-path is an image list. Defaults to 1.",
+    )
+    parser.add_argument(
+        "--report-dir",
+        dest="REPORT_DIR",
+        type=Path,
+        default=REPORT_DIR,
+        help=f"Directory to write the reports of the scanned images to, when INPUT_PATH is an image list. Reports indexed there as fresh, as by create_trivy_reports.py, i.e. written by an interrupted run, are used instead of scanning the images again. Defaults to {REPORT_DIR}.",
+    )
+    parser.add_argument(
+        "--upstream-report-dir",
+        dest="UPSTREAM_REPORT_DIR",
+        type=Path,
+        default=UPSTREAM_REPORT_DIR,
+        help=f"Directory to write the reports of the scanned images to, when --upstream-path is an image list, and resume from as with --report-dir. Defaults to {UPSTREAM_REPORT_DIR}.",
+    )
+    server_group = parser.add_mutually_exclusive_group()
+    server_group.add_argument(
+        "--trivy-server",
+        dest="TRIVY_SERVER",
+        type=str,
+        default=None,
+        help="URL of a running Trivy server to scan images with, when INPUT_PATH or --upstream-path is an image list.",
+    )
+    server_group.add_argument(
+        "--start-trivy-server",
+        dest="START_TRIVY_SERVER",
+        action="store_true",
+        help="Start a local Trivy server to scan images with, when INPUT_PATH or --upstream-path is an image list.",
+    )
 
     args = parser.parse_args()
+    if args.STORE and not args.TRACK:
+        parser.error("--track is required with --store")
+    # The delta never replaces the full report by default
+    outputs = args.OUTPUT or [
+        Path(DELTA_REPORT_FILE if args.BASELINE else REPORT_CSV_FILE)
+    ]
+    if args.BASELINE:
+        for path in outputs:
+            if path.resolve() == args.BASELINE.resolve():
+                parser.error(f"The delta report can't overwrite the baseline: {path}")
+    # Reports of scanned images must not be read back as the reports of a
+    # directory, i.e. upstream reports as Charmed Kubeflow ones. Only the
+    # report directory of an image list receives scans.
+    scanned_dirs = [
+        report_dir
+        for path, report_dir in [
+            (args.INPUT_PATH, args.REPORT_DIR),
+            (args.UPSTREAM, args.UPSTREAM_REPORT_DIR),
+        ]
+        if path and Path(path).is_file()
+    ]
+    if args.REPORT_DIR.resolve() == args.UPSTREAM_REPORT_DIR.resolve():
+        parser.error("--report-dir and --upstream-report-dir must differ")
+    for path in [args.INPUT_PATH, args.UPSTREAM]:
+        if path and Path(path).is_dir():
+            for report_dir in scanned_dirs:
+                if report_dir.resolve().is_relative_to(Path(path).resolve()):
+                    parser.error(f"Scanned reports can't be written inside {path}")
+    for path in outputs + ([args.BASELINE] if args.BASELINE else []):
+        if path.suffix not in REPORT_FORMATS:
+            parser.error(f"Unsupported report format: {path}")
+        if path.suffix == ".parquet" and pyarrow is None:
+            parser.error(f"pyarrow is required to read or write {path}")
 
     severities = {
         severity.capitalize()
@@ -362,42 +985,92 @@ if __name__ == "__main__":
 
     logger.info(f"Selecting severities: {','.join(severities)}")
 
-    input_path = Path(args.INPUT_PATH)
-    if input_path.is_file():
-        logger.info("Input detected as file; treating as image list.")
-        data = iter_images(str(input_path))
-    elif input_path.is_dir():
-        logger.info("Input detected as directory; treating as folder reports.")
-        data = iter_reports(str(input_path))
-    else:
-        raise FileNotFoundError(f"Input path {input_path} does not exist")
-
-    upstream_cves = (
-        get_upstream_cves(iter_reports(args.UPSTREAM)) if args.UPSTREAM else None
-    )
-
-    if args.TICKETS:
-        actions = read_tickets(args.TICKETS)
-    else:
-        actions = {}
+    with contextlib.ExitStack() as stack:
+        image_lists = [
+            path
+            for path in [args.INPUT_PATH, args.UPSTREAM]
+            if path and Path(path).is_file()
+        ]
+        server = args.TRIVY_SERVER
+        if args.START_TRIVY_SERVER and image_lists:
+            server = stack.enter_context(trivy_server())
+        db_version = None
+        if image_lists:
+            # The DB of a remote server is unknown, its reports only expire with the TTL
+            db_version = (
+                f"server {args.TRIVY_SERVER}"
+                if args.TRIVY_SERVER
+                else get_trivy_db_version()
+            )
+
+        def iter_scans(
+            path: Path,
+            report_dir: Path = args.REPORT_DIR,
+            shared_dir: Path = args.UPSTREAM_REPORT_DIR,
+        ) -> typing.Iterator[tuple[str, dict]]:
+            if path.is_file():
+                logger.info(f"{path} detected as file; treating as image list.")
+                return iter_images(
+                    str(path),
+                    server,
+                    args.PARALLEL,
+                    report_dir,
+                    db_version,
+                    [shared_dir],
+                )
+            elif path.is_dir():
+                logger.info(
+                    f"{path} detected as directory; treating as folder reports."
+                )
+                return iter_reports(str(path), args.JOBS)
+            raise FileNotFoundError(f"Input path {path} does not exist")
+
+        data = iter_scans(Path(args.INPUT_PATH))
+
+        # The scans of an upstream list have their own report directory, and
+        # share their reports with the Charmed Kubeflow list the other way round
+        upstream_cves = load_upstream_cves(
+            args.UPSTREAM,
+            args.UPSTREAM_RELEASE,
+            Path(args.UPSTREAM_INDEX),
+            lambda path: iter_scans(path, args.UPSTREAM_REPORT_DIR, args.REPORT_DIR),
+        )
 
-    cve_list = scan_images(
-        data,
-        get_kves(Path(args.KEV_FILE)),
-        get_exceptions(Path(args.EXCEPTIONS)),
-        upstream_cves,
-        actions,
-    )
+        if args.TICKETS:
+            actions = read_tickets(args.TICKETS)
+        else:
+            actions = {}
+
+        if args.STORE:
+            # The report is a view on the findings of this run in the store
+            store = stack.enter_context(FindingsStore(Path(args.STORE)))
+            findings = store.get_findings(store_scans(data, store, args.TRACK))
+        else:
+            findings = pd.DataFrame(flatten_vulnerabilities(data), dtype=object)
+
+        cve_list = report_findings(
+            findings,
+            get_kves(Path(args.KEV_FILE)),
+            get_exceptions(Path(args.EXCEPTIONS)),
+            upstream_cves,
+            actions,
+        )
 
     if severities:
         cve_list = cve_list[cve_list["Severity"].isin(list(severities))]
 
     merged_list = merge_cve(cve_list)
 
-    with pd.ExcelWriter(REPORT_CSV_FILE) as writer:
-        merged_list.to_excel(writer, sheet_name="All Vulnerabilities")
-        merged_list[
-            (merged_list["Severity"] == "Critical")
-            + (merged_list["Severity"] == "High")
-            + (merged_list["Is KEV?"] == "Yes")
-        ].to_excel(writer, sheet_name="Critical, High, KEVs")
+    if args.BASELINE:
+        baseline = read_report(args.BASELINE)
+        if severities:
+            baseline = baseline[baseline["Severity"].isin(list(severities))]
+        delta = get_delta(merged_list, baseline)
+        counts = delta["Change"].value_counts()
+        logger.info(
+            f"Changes since the baseline: {counts.get('New', 0)} new, "
+            f"{counts.get('Changed', 0)} changed, {counts.get('Resolved', 0)} resolved"
+        )
+        write_delta(delta, outputs)
+    else:
+        write_report(merged_list, outputs)
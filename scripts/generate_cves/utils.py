@@ -0,0 +1,238 @@
+import argparse
+import contextlib
+import hashlib
+import json
+import logging
+import os
+import pickle
+import subprocess
+import tempfile
+import time
+import typing
+import urllib.error
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+logger = logging.getLogger(__name__)
+
+TRIVY_SERVER_LISTEN = "127.0.0.1:4954"
+# The server downloads the vulnerability DB before it becomes healthy
+TRIVY_SERVER_START_TIMEOUT = 600
+
+# Bumped whenever the content of the sidecar files changes
+SIDECAR_VERSION = 1
+
+TRIVY_REPORT_TYPE = "json"
+
+DEFAULT_REGISTRY = "docker.io"
+DIGEST_TOKEN = "@sha256:"
+
+
+def ensure_positive_int(value: str) -> int:
+    """Ensure a given value is a positive integer."""
+    number = int(value)
+    if number < 1:
+        raise argparse.ArgumentTypeError(f"Expected a positive integer: {value}")
+    return number
+
+
+def normalize_image_name(image: str) -> str:
+    """Normalize the image of the image to avoid difficult characters."""
+    return image.replace(":", "-").replace("/", "-").replace(".", "-")
+
+
+def get_report_path(image: str, output_dir: Path) -> Path:
+    """Return the path of the report of an image."""
+    normalized = normalize_image_name(image)
+    return output_dir / f"{normalized}.{TRIVY_REPORT_TYPE}"
+
+
+def write_atomic(path: Path, content: str | bytes) -> None:
+    """Write a file through a temporary file, so that it only exists once complete."""
+    partial_path = path.with_name(f"{path.name}.part")
+    if isinstance(content, bytes):
+        partial_path.write_bytes(content)
+    else:
+        partial_path.write_text(content)
+    os.replace(partial_path, path)
+
+
+def get_file_sha256(path: Path) -> str:
+    sha256 = hashlib.sha256()
+    with open(path, "rb") as fid:
+        for chunk in iter(lambda: fid.read(1 << 20), b""):
+            sha256.update(chunk)
+    return sha256.hexdigest()
+
+
+def load_with_sidecar(source: Path, build: typing.Callable[[Path], typing.Any]):
+    """Return build(source), cached in a sidecar file next to the source.
+
+    The sidecar is reused as long as the modification time and size of the
+    source are unchanged, or else as long as its SHA256 is, so that slow
+    inputs such as spreadsheets are only parsed again when they change.
+    """
+    sidecar = source.with_name(f".{source.name}.cache")
+    stat = source.stat()
+    key = {"version": SIDECAR_VERSION, "mtime_ns": stat.st_mtime_ns, "size": stat.st_size}
+
+    cached = {}
+    try:
+        with open(sidecar, "rb") as fid:
+            cached = pickle.load(fid)
+    except FileNotFoundError:
+        pass
+    except Exception as error:
+        logger.warning(f"Ignoring unreadable sidecar {sidecar}: {error}")
+
+    if cached.get("version") == key["version"]:
+        if (cached["mtime_ns"], cached["size"]) == (key["mtime_ns"], key["size"]):
+            logger.info(f"Loading {source} from {sidecar}")
+            return cached["value"]
+
+    key["sha256"] = get_file_sha256(source)
+    if cached.get("version") == key["version"] and cached["sha256"] == key["sha256"]:
+        logger.info(f"Loading {source} from {sidecar}")
+        value = cached["value"]
+    else:
+        value = build(source)
+
+    try:
+        write_atomic(sidecar, pickle.dumps({**key, "value": value}))
+    except OSError as error:
+        logger.warning(f"Could not write sidecar {sidecar}: {error}")
+    return value
+
+
+def normalize_image_reference(image: str) -> str:
+    """Return the fully qualified form of an image reference.
+
+    The registry, the library/ namespace of official images and the latest
+    tag are made explicit, i.e. `ubuntu` becomes `docker.io/library/ubuntu:latest`.
+    """
+    name, digest = image, ""
+    if DIGEST_TOKEN in image:
+        name, digest = image.split("@", 1)
+        digest = f"@{digest}"
+
+    parts = name.split("/")
+    if len(parts) == 1 or not ("." in parts[0] or ":" in parts[0] or parts[0] == "localhost"):
+        parts.insert(0, DEFAULT_REGISTRY)
+    if parts[0] == DEFAULT_REGISTRY and len(parts) == 2:
+        parts.insert(1, "library")
+    if ":" not in parts[-1] and not digest:
+        parts[-1] += ":latest"
+
+    return "/".join(parts) + digest
+
+
+def resolve_image_digest(image: str) -> str | None:
+    """Return the manifest digest of an image, or None if unknown.
+
+    Like Trivy, the local docker daemon is looked up first, and then the
+    registry. Images built locally have no manifest digest, their ID is
+    returned instead.
+    """
+    if DIGEST_TOKEN in image:
+        return image.split("@", 1)[1]
+
+    try:
+        result = subprocess.run(
+            ["docker", "image", "inspect", "--format", "{{json .RepoDigests}} {{.Id}}", image],
+            capture_output=True,
+            text=True,
+        )
+        if result.returncode == 0:
+            repo_digests, image_id = result.stdout.strip().rsplit(" ", 1)
+            repo_digests = json.loads(repo_digests)
+            return repo_digests[0].split("@", 1)[1] if repo_digests else image_id
+
+        result = subprocess.run(
+            ["docker", "buildx", "imagetools", "inspect", "--format", "{{json .Manifest}}", image],
+            capture_output=True,
+            text=True,
+        )
+        if result.returncode == 0:
+            return json.loads(result.stdout)["digest"]
+    except (FileNotFoundError, json.JSONDecodeError, KeyError, ValueError) as e:
+        logger.debug(f"Could not resolve the digest of {image}: {e}")
+        return None
+
+    logger.debug(f"Could not resolve the digest of {image}")
+    return None
+
+
+def group_images_by_digest(images: list[str], jobs: int = 1) -> dict[str, list[str]]:
+    """Group the references of a list of images that point to the same image.
+
+    References are grouped by manifest digest, or by their normalized form if
+    the digest can't be resolved, so that each image is only scanned once.
+    The groups, and the references within them, keep the order of the list.
+
+    Returns:
+        dict mapping the digest, or normalized reference, of each image to
+        its references
+    """
+    images = list(dict.fromkeys(images))
+    with ThreadPoolExecutor(max_workers=jobs) as executor:
+        digests = list(executor.map(resolve_image_digest, images))
+
+    groups = {}
+    for image, digest in zip(images, digests):
+        groups.setdefault(digest or normalize_image_reference(image), []).append(image)
+
+    logger.info(f"Found {len(groups)} unique images among {len(images)} references")
+    return groups
+
+
+def is_trivy_server_healthy(server_url: str) -> bool:
+    """Return whether the Trivy server at server_url is ready to serve scans."""
+    try:
+        with urllib.request.urlopen(f"{server_url}/healthz", timeout=5) as response:
+            return response.status == 200
+    except (urllib.error.URLError, ConnectionError, TimeoutError):
+        return False
+
+
+@contextlib.contextmanager
+def trivy_server(
+    listen: str = TRIVY_SERVER_LISTEN, timeout: float = TRIVY_SERVER_START_TIMEOUT
+) -> typing.Iterator[str]:
+    """Start a local Trivy server, and stop it on exit.
+
+    The vulnerability DB is loaded once by the server, and shared by all the
+    scans run with `trivy image --server`. Yields the URL of the server.
+    """
+    server_url = f"http://{listen}"
+    with tempfile.TemporaryFile(mode="w+") as server_log:
+        logger.info(f"Starting Trivy server on {server_url}")
+        process = subprocess.Popen(
+            ["trivy", "server", "--listen", listen, "-q"],
+            stdout=server_log,
+            stderr=subprocess.STDOUT,
+            text=True,
+        )
+        try:
+            deadline = time.time() + timeout
+            while not is_trivy_server_healthy(server_url):
+                if process.poll() is not None:
+                    server_log.seek(0)
+                    raise RuntimeError(
+                        f"Trivy server exited with code {process.returncode}: "
+                        f"{server_log.read().strip()}"
+                    )
+                if time.time() > deadline:
+                    raise RuntimeError(f"Trivy server not ready after {timeout}s")
+                time.sleep(1)
+
+            logger.info("Trivy server is ready")
+            yield server_url
+        finally:
+            logger.info("Stopping Trivy server")
+            process.terminate()
+            try:
+                process.wait(timeout=30)
+            except subprocess.TimeoutExpired:
+                process.kill()
+                process.wait()
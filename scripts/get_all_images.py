@@ -1,13 +1,21 @@
 #!/usr/bin/env python3
 
 import argparse
+import collections
 import logging
 import subprocess
 import os
 import sys
 import contextlib
+import fcntl
+import glob
+import hashlib
+import json
 import tempfile
 
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from dataclasses import dataclass
+
 import git
 import yaml
 
@@ -27,6 +35,54 @@ GH_BRANCH_KEY = "_github_repo_branch"
 GH_DEPENDENCY_REPO_KEY = "_github_dependency_repo_name"
 GH_DEPENDENCY_BRANCH_KEY = "_github_dependency_repo_branch"
 GET_IMAGES_SH = "tools/get-images.sh"
+GH_ORG_URL = "https://github.com/canonical"
+RELEASES_DIR = Path(__file__).resolve().parent.parent / "releases"
+COMBINED_IMAGES_FILE = "all-images.txt"
+
+# files checked out by the shallow fetch strategy, as gitignore-style patterns.
+# The repos of our charms are fully checked out, since their get-images.sh
+# scripts may read any file.
+DEPENDENCY_SPARSE_PATHS = ["/metadata.yaml"]
+
+
+@dataclass
+class CloneOptions:
+    """
+    Options controlling where charm repositories are fetched from.
+
+    Attributes:
+        cache_dir: directory keeping bare mirrors of the repos between runs.
+            If None, every repo is cloned from scratch into a temporary dir.
+        mirror_root: base URL (i.e. file:///srv/git) to fetch repos from,
+            instead of the canonical GitHub org.
+        shallow: only fetch the tip of the branch, and only check out the
+            metadata.yaml of dependency charms.
+    """
+    cache_dir: Path | None = None
+    mirror_root: str | None = None
+    shallow: bool = False
+
+
+@dataclass(frozen=True)
+class ImageJob:
+    """
+    Unit of work gathering the images of a repo's branch. Applications whose
+    charms live in the same repo and branch share the same job.
+
+    Attributes:
+        repo: name of the repo to clone
+        branch: branch to checkout to
+        dependency: whether images are gathered from the metadata.yaml of a
+            dependency charm, instead of the repo's tools/get-images.sh
+    """
+    repo: str
+    branch: str
+    dependency: bool
+
+
+# mirrors already fetched by this run, so that a repo used by multiple
+# branches or applications is only fetched once
+_FETCHED_MIRRORS = set()
 
 
 def is_dependency_app(app: dict) -> bool:
@@ -83,30 +139,164 @@ def validate_bundle(bundle: dict):
         sys.exit(1)
 
 
+def get_repo_url(repo_name: str, mirror_root: str | None = None) -> str:
+    """
+    Return the URL to fetch a repo from.
+
+    Args:
+        repo_name(str): name of the repo
+        mirror_root(str): base URL of a mirror of the canonical GitHub org
+    """
+    if mirror_root:
+        return f"{mirror_root.rstrip('/')}/{repo_name}.git"
+
+    return f"{GH_ORG_URL}/{repo_name}.git"
+
+
 @contextlib.contextmanager
-def clone_git_repo(repo_name: str, branch: str) -> Iterator[git.PathLike]:
+def lock_mirror(mirror_path: Path) -> Iterator[None]:
+    """
+    Hold an exclusive lock on a cached mirror, to serialise fetches and
+    worktree changes between threads and concurrent runs of the script.
+    """
+    with open(f"{mirror_path}.lock", "w") as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+def update_mirror(repo_url: str, cache_dir: Path) -> Path:
+    """
+    Ensure a bare mirror of a repo exists in the cache and is up to date,
+    and return its path.
+
+    The mirror's directory name is derived from the hash of the repo's URL,
+    so that the same repo fetched from different sources never collides.
+    The first run creates the mirror, and next runs only fetch new objects.
+
+    Args:
+        repo_url(str): URL of the repo to mirror
+        cache_dir(Path): directory containing the mirrors
+    """
+    url_hash = hashlib.sha256(repo_url.encode()).hexdigest()[:16]
+    repo_name = repo_url.rstrip("/").rsplit("/", 1)[-1].removesuffix(".git")
+    mirror_path = cache_dir / f"{repo_name}-{url_hash}.git"
+
+    cache_dir.mkdir(parents=True, exist_ok=True)
+    with lock_mirror(mirror_path):
+        if mirror_path in _FETCHED_MIRRORS:
+            return mirror_path
+
+        if mirror_path.is_dir():
+            logging.info(f"Fetching updates of cached mirror {repo_url}")
+            mirror = git.Git(mirror_path)
+            mirror.remote("update", "--prune")
+            # drop worktrees left behind by interrupted runs
+            mirror.worktree("prune")
+        else:
+            logging.info(f"Creating cached mirror of repo {repo_url}")
+            git.Repo.clone_from(repo_url, mirror_path, mirror=True)
+
+        _FETCHED_MIRRORS.add(mirror_path)
+
+    return mirror_path
+
+
+def sparse_checkout(repo: git.Repo, sparse_paths: list[str]):
+    """
+    Check out only the files of a repo cloned without checkout that match
+    the given gitignore-style patterns.
+    """
+    repo.git.sparse_checkout("set", "--no-cone", *sparse_paths)
+    repo.git.checkout("--detach")
+
+
+@contextlib.contextmanager
+def clone_git_repo(repo_name: str, branch: str,
+                   options: CloneOptions | None = None,
+                   sparse_paths: list[str] | None = None
+                   ) -> Iterator[git.PathLike]:
     """
     Clones locally a repo and returns the path of the folder created.
 
+    If a cache dir is configured the repo is checked out as a worktree of a
+    cached mirror, instead of being cloned from scratch.
+
+    If the shallow strategy is enabled the repo is cloned at depth 1 with a
+    single branch and without fetching files up front. Only the files
+    matching `sparse_paths` are checked out, if given.
+
     Args:
         repo_name(str): name of the repo to clone
         branch(str): branch to checkout to, once cloned the repo
+        options(CloneOptions): where and how to fetch the repo
+        sparse_paths(list[str]): files to check out with the shallow strategy
     """
-    repo_url = f"https://github.com/canonical/{repo_name}.git"
+    options = options or CloneOptions()
+    repo_url = get_repo_url(repo_name, options.mirror_root)
+    sparse_paths = sparse_paths if options.shallow else None
 
     # we can't use the default /tmp/ dir because of
     # https://github.com/mikefarah/yq/issues/1808
     with tempfile.TemporaryDirectory(dir=os.getcwd()) as tmp:
-        logging.info(f"Cloning repo {repo_url}")
-        repo = git.Repo.clone_from(repo_url, tmp)
+        if not options.cache_dir and options.shallow:
+            logging.info(f"Shallow cloning branch {branch} of repo {repo_url}")
+            repo = git.Repo.clone_from(repo_url, tmp, depth=1, branch=branch,
+                                       single_branch=True,
+                                       no_checkout=bool(sparse_paths),
+                                       filter="blob:none")
+            if sparse_paths:
+                sparse_checkout(repo, sparse_paths)
+
+            yield repo.working_dir
+            return
+
+        if not options.cache_dir:
+            logging.info(f"Cloning repo {repo_url}")
+            repo = git.Repo.clone_from(repo_url, tmp)
+
+            logging.info(f"Checking out to branch {branch}")
+            repo.git.checkout(branch)
+
+            yield repo.working_dir
+            return
+
+        mirror_path = update_mirror(repo_url, Path(options.cache_dir))
+        # git.Repo can't tell a mirror with sparse worktrees is bare, since
+        # git then moves core.bare to the config.worktree file
+        mirror = git.Git(mirror_path)
+        worktree_dir = os.path.join(tmp, repo_name)
+
+        logging.info(f"Checking out branch {branch} of cached repo {repo_url}")
+        with lock_mirror(mirror_path):
+            if sparse_paths:
+                # setting up a sparse worktree writes to the mirror's config
+                mirror.worktree("add", "--no-checkout", "--detach",
+                                worktree_dir, branch)
+                sparse_checkout(git.Repo(worktree_dir), sparse_paths)
+            else:
+                mirror.worktree("add", "--detach", worktree_dir, branch)
+
+        try:
+            yield worktree_dir
+        finally:
+            with lock_mirror(mirror_path):
+                mirror.worktree("remove", "--force", worktree_dir)
 
-        logging.info(f"Checking out to branch {branch}")
-        repo.git.checkout(branch)
 
-        yield repo.working_dir
+def run_get_images_script(repo_dir: git.PathLike
+                          ) -> subprocess.CompletedProcess:
+    """Run the tools/get-images.sh script of a cloned repo."""
+    logging.info(f"Executing repo's {GET_IMAGES_SH} script")
+    return subprocess.run(["bash", GET_IMAGES_SH], cwd=repo_dir,
+                          capture_output=True, text=True)
 
 
-def get_analytics_app_images(app: dict) -> list[str]:
+def get_analytics_app_images(app: dict,
+                             options: CloneOptions | None = None
+                             ) -> list[str]:
     """
     This function gets the images used by a charm developed by us, by:
     1. Cloning the repo of the charm
@@ -114,18 +304,18 @@ def get_analytics_app_images(app: dict) -> list[str]:
     3. Delete the repo
 
     If the tools/get-images.sh of a repo fails for any reason then this
-    script will also fail.
+    script will also fail. The repo is always fully checked out, even with
+    the shallow strategy, since the script may read any of its files.
     """
     images = []
     repo_name = app[GH_REPO_KEY]
     repo_branch = app[GH_BRANCH_KEY]
 
-    with clone_git_repo(repo_name, repo_branch) as repo_dir:
-        logging.info(f"Executing repo's {GET_IMAGES_SH} script")
+    with clone_git_repo(repo_name, repo_branch, options) as repo_dir:
+        process = run_get_images_script(repo_dir)
+
         try:
-            process = subprocess.run(["bash", "tools/get-images.sh"],
-                                     cwd=repo_dir, capture_output=True,
-                                     text=True, check=True)
+            process.check_returncode()
         except subprocess.CalledProcessError as exc:
             logging.error("Script '%s' for charm '%s' failed: %s",
                           GET_IMAGES_SH, app["charm"], exc.stderr)
@@ -133,14 +323,16 @@ def get_analytics_app_images(app: dict) -> list[str]:
 
     images = process.stdout.strip().split("\n")
 
-    logging.info("Found the following images:")
+    logging.info("Found the following images for charm '%s':", app["charm"])
     for image in images:
         logging.info("* " + image)
 
     return images
 
 
-def get_dependency_app_images(app: dict) -> list[str]:
+def get_dependency_app_images(app: dict,
+                              options: CloneOptions | None = None
+                              ) -> list[str]:
     """
     This function gets the images used by a dependency charm by:
     1. Cloning the repo of the charm
@@ -150,7 +342,8 @@ def get_dependency_app_images(app: dict) -> list[str]:
     images = []
     repo_name = app[GH_DEPENDENCY_REPO_KEY]
     repo_branch = app[GH_DEPENDENCY_BRANCH_KEY]
-    with clone_git_repo(repo_name, repo_branch) as repo_dir:
+    with clone_git_repo(repo_name, repo_branch, options,
+                        DEPENDENCY_SPARSE_PATHS) as repo_dir:
         metatada_file = f"{repo_dir}/metadata.yaml"
         metadata_dict = yaml.safe_load(Path(metatada_file).read_text())
 
@@ -160,13 +353,40 @@ def get_dependency_app_images(app: dict) -> list[str]:
 
             images.append(rsrc["upstream-source"])
 
-    logging.info("Found the following images:")
+    logging.info("Found the following images for charm '%s':", app["charm"])
     for image in images:
         logging.info("* " + image)
 
     return images
 
 
+def get_app_images(app_name: str, app: dict,
+                   options: CloneOptions | None = None) -> list[str]:
+    """
+    Return the images used by a single application of a bundle, following
+    the dependency or analytics image-gather process depending on its
+    metadata.
+
+    Args:
+        app_name(str): name of the application in the bundle
+        app(dict): app metadata from a bundle.yaml in dictionary form
+        options(CloneOptions): where to fetch the app's repo from
+
+    Returns:
+        list of images found for the application
+    """
+    logging.info(f"Handling app {app_name}")
+
+    # Follow default image-gather process for dependency apps
+    if is_dependency_app(app):
+        logging.info("Dependency app '%s' with charm '%s'", app_name,
+                     app["charm"])
+        return get_dependency_app_images(app, options)
+
+    # image from analytics team
+    return get_analytics_app_images(app, options)
+
+
 def cleanup_images(images: list[str]) -> list[str]:
     """
     Given a list of OCI registry images ensure
@@ -190,16 +410,28 @@ def cleanup_images(images: list[str]) -> list[str]:
     return unique_images
 
 
-def get_bundle_images(bundle_path: str) -> list[str]:
-    """Return a list of images used by a bundle"""
-    bundle_dict = yaml.safe_load(Path(bundle_path).read_text())
-    validate_bundle(bundle_dict)
+def get_image_job(app: dict) -> ImageJob:
+    """Return the job gathering the images of an application of a bundle."""
+    if is_dependency_app(app):
+        return ImageJob(app[GH_DEPENDENCY_REPO_KEY],
+                        app[GH_DEPENDENCY_BRANCH_KEY], dependency=True)
 
-    images = []
+    return ImageJob(app[GH_REPO_KEY], app[GH_BRANCH_KEY], dependency=False)
 
-    for app_name, app in bundle_dict["applications"].items():
-        logging.info(f"Handling app {app_name}")
 
+def plan_image_jobs(applications: dict) -> dict[ImageJob, dict[str, dict]]:
+    """
+    Group the applications of a bundle by the job gathering their images, so
+    that every repo and branch is only cloned once.
+
+    Args:
+        applications(dict): the applications of a bundle
+
+    Returns:
+        dict mapping each job to the applications, by name, it serves
+    """
+    plan = {}
+    for app_name, app in applications.items():
         # exclude repos we know don't have images
         # if we find we keep extending this const, we should introduce an
         # argument in the script for dynamically exluding repos/charms
@@ -207,17 +439,319 @@ def get_bundle_images(bundle_path: str) -> list[str]:
             logging.info("Ignoring charm %s", app["charm"])
             continue
 
-        # Follow default image-gather process for dependency apps
-        if is_dependency_app(app):
-            logging.info("Dependency app '%s' with charm '%s'", app_name,
-                         app["charm"])
-            images.extend(get_dependency_app_images(app))
-            continue
+        plan.setdefault(get_image_job(app), {})[app_name] = app
+
+    return plan
 
-        # image from analytics team
-        images.extend(get_analytics_app_images(app))
 
-    return cleanup_images(images)
+def run_image_jobs(plan: dict[ImageJob, dict[str, dict]], jobs: int = 1,
+                   options: CloneOptions | None = None,
+                   apps_count: int | None = None
+                   ) -> dict[ImageJob, list[str]]:
+    """
+    Run every job of a plan once, with a pool of `jobs` workers.
+
+    A failing job does not stop the others; the failures are reported for
+    every application they affect once all jobs have run, and the script
+    then exits.
+
+    Args:
+        plan(dict): jobs to run, and the applications they serve
+        jobs(int): number of jobs to run concurrently
+        options(CloneOptions): where to fetch the repos from
+        apps_count(int): number of applications to report the failures
+            against, when the plan only holds the pending jobs of a larger
+            one. Defaults to the applications of the plan.
+
+    Returns:
+        dict mapping each job to the images it found
+    """
+    results = {}
+    failures = {}
+
+    with ThreadPoolExecutor(max_workers=jobs) as executor:
+        futures = {}
+        for job, apps in plan.items():
+            app_name, app = next(iter(apps.items()))
+            if len(apps) > 1:
+                logging.info("Apps %s share the images of app '%s'",
+                             ", ".join(sorted(apps)), app_name)
+
+            future = executor.submit(get_app_images, app_name, app, options)
+            futures[future] = job
+
+        for future in as_completed(futures):
+            job = futures[future]
+            try:
+                results[job] = future.result()
+            except Exception as exc:
+                failures[job] = exc
+
+    if failures:
+        failed_apps = sorted((app_name, exc)
+                             for job, exc in failures.items()
+                             for app_name in plan[job])
+        for app_name, exc in failed_apps:
+            logging.error("Failed to gather images for app '%s': %s",
+                          app_name, exc)
+        if apps_count is None:
+            apps_count = sum(len(apps) for apps in plan.values())
+        logging.error("Failed to gather images for %s/%s applications.",
+                      len(failed_apps), apps_count)
+        sys.exit(1)
+
+    return results
+
+
+def load_bundle(bundle_path: str) -> dict:
+    """Load a bundle.yaml file and ensure its applications can be parsed."""
+    bundle_dict = yaml.safe_load(Path(bundle_path).read_text())
+    validate_bundle(bundle_dict)
+
+    return bundle_dict
+
+
+def get_app_entry_hash(app: dict) -> str:
+    """Return a hash of an application's entry in a bundle."""
+    return hashlib.sha256(json.dumps(app, sort_keys=True).encode()).hexdigest()
+
+
+def get_branch_commit(job: ImageJob,
+                      options: CloneOptions | None = None) -> str | None:
+    """
+    Return the commit at the tip of a job's branch, without cloning its repo,
+    or None if it can't be resolved.
+    """
+    options = options or CloneOptions()
+    repo_url = get_repo_url(job.repo, options.mirror_root)
+    try:
+        refs = git.Git().ls_remote(repo_url, f"refs/heads/{job.branch}")
+    except git.GitCommandError as exc:
+        logging.warning("Failed to resolve branch %s of repo %s: %s",
+                        job.branch, repo_url, exc)
+        return None
+
+    return refs.split()[0] if refs else None
+
+
+def get_branch_commits(plan: dict[ImageJob, dict[str, dict]], jobs: int = 1,
+                       options: CloneOptions | None = None
+                       ) -> dict[ImageJob, str | None]:
+    """Return the commit at the tip of the branch of every job of a plan."""
+    with ThreadPoolExecutor(max_workers=jobs) as executor:
+        commits = executor.map(lambda job: get_branch_commit(job, options),
+                               plan)
+        return dict(zip(plan, commits))
+
+
+def load_state(state_file: Path) -> dict:
+    """
+    Load the state saved by a previous run, with the following structure:
+    { <BUNDLE>: { <APP>: { "entry": <HASH>, "commit": <SHA>,
+                           "images": [<IMAGE>, ...] } } }
+    """
+    if not state_file.is_file():
+        return {}
+
+    return json.loads(state_file.read_text())
+
+
+def save_state(state_file: Path, state: dict,
+               bundle_plans: dict[str, dict[ImageJob, dict[str, dict]]],
+               commits: dict[ImageJob, str | None],
+               results: dict[ImageJob, list[str]]):
+    """
+    Save the resolved commit and images of every application of the given
+    bundles. The state of other bundles, saved by previous runs, is kept.
+    Bundles are keyed by their resolved path, so that they are found again
+    whether they are given by a relative or an absolute path.
+    """
+    for bundle_path, bundle_plan in bundle_plans.items():
+        state[str(Path(bundle_path).resolve())] = {
+            app_name: {
+                "entry": get_app_entry_hash(app),
+                "commit": commits[job],
+                "images": results[job],
+            }
+            for job, apps in bundle_plan.items()
+            for app_name, app in apps.items()
+        }
+
+    state_file.write_text(json.dumps(state, indent=2, sort_keys=True))
+
+
+def get_cached_results(bundle_plans: dict[str, dict[ImageJob, dict[str, dict]]],
+                       state: dict, commits: dict[ImageJob, str | None]
+                       ) -> dict[ImageJob, list[str]]:
+    """
+    Return the images saved in the state for the jobs whose branch has not
+    moved, and whose applications' bundle entries have not changed, since
+    the state was saved.
+    """
+    cached = {}
+    stale = set()
+    for bundle_path, bundle_plan in bundle_plans.items():
+        bundle_state = state.get(str(Path(bundle_path).resolve()), {})
+        for job, apps in bundle_plan.items():
+            for app_name, app in apps.items():
+                app_state = bundle_state.get(app_name)
+                if (app_state is None or commits[job] is None
+                        or app_state["commit"] != commits[job]
+                        or app_state["entry"] != get_app_entry_hash(app)):
+                    stale.add(job)
+                else:
+                    cached[job] = app_state["images"]
+
+    return {job: images for job, images in cached.items() if job not in stale}
+
+
+def get_bundles_images(bundle_paths: list[str], jobs: int = 1,
+                       options: CloneOptions | None = None,
+                       state_file: Path | None = None
+                       ) -> dict[str, list[str]]:
+    """
+    Return the images used by each of the given bundles.
+
+    A single plan is built across all the bundles, so that a repo and branch
+    used by multiple applications, in one or more bundles, is only cloned
+    once, by a pool of `jobs` workers.
+
+    If a state file is given, the images of repos whose branch has not moved,
+    and whose applications' bundle entries have not changed, are reused from
+    the previous run instead of being gathered again.
+
+    Args:
+        bundle_paths(list[str]): paths of the bundle.yaml files
+        jobs(int): number of repos to handle concurrently
+        options(CloneOptions): where to fetch the apps' repos from
+        state_file(Path): file keeping the images found by previous runs
+
+    Returns:
+        dict mapping each bundle path to its unique and sorted images
+    """
+    bundle_plans = {}
+    plan = {}
+    for bundle_path in bundle_paths:
+        bundle_dict = load_bundle(bundle_path)
+        bundle_plans[bundle_path] = plan_image_jobs(
+            bundle_dict["applications"])
+
+        for job, apps in bundle_plans[bundle_path].items():
+            # prefix apps with their bundle, as bundles share app names
+            if len(bundle_paths) > 1:
+                apps = {f"{bundle_path}:{app_name}": app
+                        for app_name, app in apps.items()}
+            plan.setdefault(job, {}).update(apps)
+
+    apps_count = sum(len(apps) for apps in plan.values())
+    logging.info("Planned %s clones for %s applications in %s bundles "
+                 "(%s clones saved)", len(plan), apps_count,
+                 len(bundle_paths), apps_count - len(plan))
+
+    results = {}
+    if state_file:
+        state = load_state(state_file)
+        commits = get_branch_commits(plan, jobs, options)
+        results = get_cached_results(bundle_plans, state, commits)
+        logging.info("Reusing images of %s unchanged repos from '%s', "
+                     "%s repos to handle", len(results), state_file,
+                     len(plan) - len(results))
+
+    pending = {job: apps for job, apps in plan.items() if job not in results}
+    results.update(run_image_jobs(pending, jobs, options, apps_count))
+
+    if state_file:
+        save_state(state_file, state, bundle_plans, commits, results)
+
+    return {
+        bundle_path: cleanup_images([image for job in bundle_plan
+                                     for image in results[job]])
+        for bundle_path, bundle_plan in bundle_plans.items()
+    }
+
+
+def get_bundle_images(bundle_path: str, jobs: int = 1,
+                      options: CloneOptions | None = None) -> list[str]:
+    """
+    Return a list of images used by a bundle.
+
+    Applications sharing a repo and branch are grouped, and each group's
+    repo is only cloned once, by a pool of `jobs` workers.
+
+    Args:
+        bundle_path(str): path of the bundle.yaml file
+        jobs(int): number of repos to handle concurrently
+        options(CloneOptions): where to fetch the apps' repos from
+
+    Returns:
+        A list with unique and sorted images.
+    """
+    return get_bundles_images([bundle_path], jobs, options)[bundle_path]
+
+
+def get_track_bundle_paths(track: str) -> list[str]:
+    """
+    Return the bundle.yaml files of a release track, i.e. 1.10/stable.
+
+    Older tracks contain one directory per bundle (i.e. kubeflow and
+    kubeflow-lite) instead of a single bundle.yaml file.
+    """
+    track_dir = RELEASES_DIR / track
+    if (track_dir / "bundle.yaml").is_file():
+        return [str(track_dir / "bundle.yaml")]
+
+    return sorted(str(path) for path in track_dir.glob("*/bundle.yaml"))
+
+
+def resolve_bundle_paths(patterns: list[str], tracks: list[str]) -> list[str]:
+    """
+    Return the bundle.yaml files matching the given glob patterns, and the
+    ones of the given release tracks, without duplicates.
+    """
+    bundle_paths = []
+    for pattern in patterns:
+        matches = sorted(glob.glob(pattern, recursive=True))
+        if not matches:
+            logging.error("No bundle found matching '%s'", pattern)
+            sys.exit(1)
+        bundle_paths.extend(matches)
+
+    for track in tracks:
+        matches = get_track_bundle_paths(track)
+        if not matches:
+            logging.error("No bundle found for track '%s'", track)
+            sys.exit(1)
+        bundle_paths.extend(matches)
+
+    # The same bundle may be given as a relative and an absolute path
+    unique_paths = {}
+    for bundle_path in bundle_paths:
+        unique_paths.setdefault(Path(bundle_path).resolve(), bundle_path)
+    return list(unique_paths.values())
+
+
+def get_images_file_name(bundle_path: str) -> str:
+    """
+    Return the name of the file listing the images of a bundle, derived from
+    the bundle's directory, i.e. 1.10-stable-images.txt for
+    releases/1.10/stable/bundle.yaml. Bundle files not named bundle.yaml add
+    their name, i.e. latest-edge-airgap-bundle-airgap-images.txt.
+    """
+    bundle_dir = Path(bundle_path).resolve().parent
+    if bundle_dir.is_relative_to(RELEASES_DIR):
+        name_parts = bundle_dir.relative_to(RELEASES_DIR).parts
+    else:
+        name_parts = (bundle_dir.name,)
+    if Path(bundle_path).stem != "bundle":
+        name_parts += (Path(bundle_path).stem,)
+
+    return "-".join(name_parts) + "-images.txt"
+
+
+def write_images_file(file_path: Path, images: list[str]):
+    """Write a list of images to a file, one per line."""
+    logging.info("Writing %s images to '%s'", len(images), file_path)
+    file_path.write_text("".join(f"{image}\n" for image in images))
 
 
 def get_static_images_from_file(images_file_path: str) -> list[str]:
@@ -242,22 +776,79 @@ def get_static_images_from_file(images_file_path: str) -> list[str]:
 
 def main():
     parser = argparse.ArgumentParser(
-        description="Gather all images from a bundle"
+        description="Gather all images from one or more bundles"
     )
-    parser.add_argument("bundle")
+    parser.add_argument("bundles", nargs="*",
+                        help="Paths of bundle.yaml files, or glob patterns "
+                             "matching them.")
+    parser.add_argument("--tracks", action="append", default=[],
+                        help="Release track, i.e. 1.10/stable, whose bundles "
+                             "to gather images from. Can be repeated.")
+    parser.add_argument("--output-dir", type=Path,
+                        help="Write the images of each bundle, and of all of "
+                             "them combined, to files in this directory.")
     parser.add_argument("--append-images",
                         help="Appends list of images from input file.")
+    parser.add_argument("-j", "--jobs", type=int, default=1,
+                        help="Number of repos to clone and gather images "
+                             "from concurrently (default: 1).")
+    parser.add_argument("--cache-dir", type=Path,
+                        help="Keep bare mirrors of the charm repos in this "
+                             "directory and reuse them across runs.")
+    parser.add_argument("--mirror-root",
+                        help="Base URL to fetch the charm repos from instead "
+                             "of GitHub, i.e. file:///srv/git-mirrors.")
+    parser.add_argument("--shallow", action="store_true",
+                        help="Only fetch the tip of each branch, and only "
+                             "check out the metadata.yaml of dependency "
+                             "charms.")
+    parser.add_argument("--state-file", type=Path,
+                        help="Keep the images found for each application in "
+                             "this file, and only gather again the ones whose "
+                             "bundle entry or branch changed since.")
 
     args = parser.parse_args()
 
-    images = get_bundle_images(args.bundle)
+    if args.jobs < 1:
+        parser.error("--jobs must be a positive integer")
+
+    if not args.bundles and not args.tracks:
+        parser.error("at least one bundle or track is required")
+
+    bundle_paths = resolve_bundle_paths(args.bundles, args.tracks)
+
+    if args.output_dir:
+        # Bundles outside of releases/ are only named after their directory
+        file_names = collections.Counter(get_images_file_name(bundle_path)
+                                         for bundle_path in bundle_paths)
+        duplicates = [name for name, count in file_names.items() if count > 1]
+        if duplicates:
+            parser.error("several bundles would be written to %s"
+                         % ", ".join(duplicates))
+
+    options = CloneOptions(cache_dir=args.cache_dir,
+                           mirror_root=args.mirror_root,
+                           shallow=args.shallow)
+    bundles_images = get_bundles_images(bundle_paths, jobs=args.jobs,
+                                        options=options,
+                                        state_file=args.state_file)
+    images = cleanup_images([image for bundle_images in bundles_images.values()
+                             for image in bundle_images])
 
     # append the airgap images
+    extra_images = []
     if args.append_images:
         logging.info("Appending images found in file '%s'", args.append_images)
         extra_images = get_static_images_from_file(args.append_images)
         images.extend(extra_images)
 
+    if args.output_dir:
+        args.output_dir.mkdir(parents=True, exist_ok=True)
+        for bundle_path, bundle_images in bundles_images.items():
+            write_images_file(args.output_dir / get_images_file_name(bundle_path),
+                              bundle_images + extra_images)
+        write_images_file(args.output_dir / COMBINED_IMAGES_FILE, images)
+
     logging.info(f"Found {len(images)} different images")
 
     for img in images:
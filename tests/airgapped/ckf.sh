@@ -29,7 +29,7 @@ function create_images_tar() {
   python3 scripts/airgapped/retag-images-to-cache.py images.txt
 
   echo "Creating images.tar.gz file with all images defined in the retagged list"
-  python3 scripts/airgapped/save-images-to-tar.py retagged-images.txt
+  python3 scripts/airgapped/save-images-to-tar.py --stream retagged-images.txt
 }
 
 function create_charms_tar() {
@@ -49,6 +49,10 @@ function copy_tars_to_airgapped_env() {
 
   echo "Pushing images.tar.gz..."
   lxc file push images.tar.gz "$NAME"/root/
+  # An images.tar.gz created before the manifest existed is pushed without it
+  if [ -f "images-manifest.json" ]; then
+      lxc file push images-manifest.json "$NAME"/root/
+  fi
 
   echo "Pushing charms.tar.gz..."
   lxc file push charms.tar.gz "$NAME"/root/
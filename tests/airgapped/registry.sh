@@ -41,17 +41,16 @@ function push_images_tar_to_registry() {
   local NAME=$1
 
   lxc exec "$NAME" -- bash -c "
-    echo \"Extracting images from tar\"
-    mkdir images
-    tar -xzvf images.tar.gz --directory images
-    rm images.tar.gz
-
-    echo \"Loading images into intermediate Docker client\"
-    for img in images/*.tar; do docker load < \$img && rm \$img; done
-    rmdir images
+    echo \"Loading images from tar into intermediate Docker client\"
+    MANIFEST_ARGS=\"\"
+    if [ -f images-manifest.json ]; then
+      MANIFEST_ARGS=\"--manifest images-manifest.json\"
+    fi
+    python3 scripts/airgapped/load-images-from-tar.py --delete \\
+      \$MANIFEST_ARGS images.tar.gz
 
     echo \"Pushing images from local docker to Registry\"
-    python3 scripts/airgapped/push-images-to-registry.py retagged-images.txt
+    python3 scripts/airgapped/retag-and-push-images.py retagged-images.txt
 
   "
 